@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+"""
+Fast path for answering the Aqualink controller.
+
+The controller only waits a short time for the PDA to answer. The reply frame for every key we can send is encoded
+once up front, so answering a frame is a key lookup and a single write, done before any other processing of the
+frame. The time from the frame arriving to the reply being written is recorded in a histogram.
+"""
+
+from __future__ import (division, print_function)
+
+import logging
+import time
+
+from metricsUtils import Histogram
+
+
+class AckEngine(object):
+    """Sends precomputed ACK frames and measures how long they took"""
+
+    # Reply window we aim to stay inside, in seconds
+    deadline = 0.01
+
+    def __init__(self, port, encoder, keys, dest, cmd, codes):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.port = port
+        self.keys = keys
+
+        # Reply frame for each key code, 0 being no key
+        self.frames = {}
+        for code in set(codes) | {0x00}:
+            self.frames[code] = encoder.encode(dest, cmd, bytes((0x40, code)))
+
+        self.latency = Histogram('ack latency')
+        self.late = 0
+
+    def ack(self, received=None):
+        """Answer the controller with the next queued key, received is the perf_counter() time the frame arrived"""
+
+        code = self.keys.next_key()
+        frame = self.frames.get(code)
+        if frame is None:
+            self.log.warning('No ACK frame for key code ' + str(code))
+            frame = self.frames[0x00]
+
+        self.port.write(frame)
+
+        if received is not None:
+            elapsed = time.perf_counter() - received
+            self.latency.observe(elapsed)
+            if elapsed > AckEngine.deadline:
+                self.late += 1
+
+        return code
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
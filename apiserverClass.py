@@ -4,11 +4,54 @@
 Creates a simple interface to send and receive API messages from AWS
 """
 
+import asyncio
+import collections
+import json
 import logging
 import datetime
-from time import sleep
+import functools
+import os
+import threading
+import time
+
+from metricsUtils import Histogram, default_buckets
+from reconnectClass import Backoff
+
+# Find our current dir and set our base dir
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Where resolved queue URLs are kept between runs
+queue_cache_file = os.path.join(base_dir, 'cache', 'sqs_queues.json')
+
+# Error codes SQS uses for a queue that has gone away
+missing_queue_codes = ('AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist')
+
+# SQS requests timed, and the buckets used, which allow for a full long poll
+timed_methods = ('send_message_batch', 'receive_message', 'delete_message_batch')
+rtt_buckets = default_buckets + (2.0, 5.0, 10.0, 20.0, 30.0)
+batch_buckets = (1, 2, 3, 4, 5, 6, 7, 8, 9, 10)
+
+# One boto3 session and client shared by every ApiServer
+_session = None
+_client = None
+
+# boto3 takes a good second to import on a Pi, so it and its error class are only loaded with the first client
+ClientError = None
+
+
+def get_client():
+    """Shared SQS client, created on first use"""
+
+    global _session, _client, ClientError
+
+    if _client is None:
+        import boto3
+        from botocore.exceptions import ClientError
+        _session = boto3.session.Session(region_name=ApiServer.region)
+        _client = _session.client('sqs')
+
+    return _client
 
-import boto3
 
 class ApiServer:
     """
@@ -17,10 +60,27 @@ class ApiServer:
 
     region = 'us-east-1'
 
+    # Seconds a receive waits for messages to arrive, 20 is the most SQS allows
+    wait_time = 20
+
+    # Most messages SQS takes in one receive or batch, and the most payload bytes in one batch
+    max_batch = 10
+    max_batch_bytes = 262144
+
+    # Attributes for queues we have to create
+    queue_attributes = {'DelaySeconds': '0',
+                        'MessageRetentionPeriod': '60',
+                        'VisibilityTimeout': '30',
+                        'FifoQueue': 'true',
+                        'ContentBasedDeduplication': 'true'
+                        }
+
     def __str__(self):
         return self.__class__.__name__ + ' Controller'
 
-    def __init__(self, read_q_name, write_q_name):
+    def __init__(self, read_q_name, write_q_name, discard_stale=False, spool=None):
+
+        started = time.time()
 
         self.log = logging.getLogger(self.__class__.__name__)
         self.log.info('Init')
@@ -31,112 +91,338 @@ class ApiServer:
         if not write_q_name.endswith('.fifo'):
             self.log.critical('SQS write queue name must end with .fifo')
 
-        # Get the service resource
-        self.sqs = boto3.client('sqs', region_name=ApiServer.region)
+        # Get the shared client
+        self.sqs = get_client()
+
+        # Messages waiting to be sent, and a count of API requests made
+        self.pending = []
+        self.requests = collections.Counter()
+
+        # Optional local spool published messages go through, the event that wakes its sender, and the batch it is
+        # sending on an executor thread
+        self.spool = spool
+        self.spooled = None
+        self.sending = None
+
+        # Flushes run on executor threads, one at a time so a message is not sent twice
+        self.flush_lock = threading.Lock()
+
+        # Round trip time per request type, and messages per batch each way
+        self.rtt = dict((method, Histogram('sqs ' + method, rtt_buckets)) for method in timed_methods)
+        self.batches = {'send': Histogram('sqs send batch', batch_buckets),
+                        'receive': Histogram('sqs receive batch', batch_buckets)}
+
+        # Commands sent before we started are dropped rather than acted on, if asked to
+        self.discard_stale = discard_stale
+        self.started = started
 
         # Set up our queues, the data will be stored in the read_q and write_q dicts
+        self.url_cache = self.load_url_cache()
         self.read_q = self.get_queue(read_q_name)
         self.write_q = self.get_queue(write_q_name)
 
+        self.cold_start = time.time() - started
+        self.log.info('Ready in {0:.3f}s'.format(self.cold_start))
+
+    @staticmethod
+    def load_url_cache():
+        try:
+            with open(queue_cache_file) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return {}
+
+    def save_url_cache(self):
+        try:
+            if not os.path.exists(os.path.dirname(queue_cache_file)):
+                os.makedirs(os.path.dirname(queue_cache_file))
+            with open(queue_cache_file, 'w') as fh:
+                json.dump(self.url_cache, fh)
+        except IOError as e:
+            self.log.warning('Unable to save queue cache: ' + str(e))
+
     def get_queue(self, q_name):
+        """Queue details, using the URL cached from a previous run if there is one.
+        The cached URL is not checked here, a request that finds the queue gone resolves it again."""
 
         q_data = {'name': q_name}
 
-        # Get a list of all the current queues
-        data = self.sqs.list_queues()
+        url = self.url_cache.get(q_name)
+        if url:
+            self.log.debug('Using cached URL for ' + q_name)
+        else:
+            try:
+                url = self.resolve_queue(q_name)
+            except Exception as e:
+                # Most likely offline, the first request will try again
+                self.log.warning('Unable to resolve ' + q_name + ': ' + str(e))
+                url = None
 
-        if data['ResponseMetadata']['HTTPStatusCode'] != 200:
-            self.log.error('Falied to get list of sqs queues')
-            self.log.critical(data)
+        q_data['url'] = url
 
-        all_queues = data['QueueUrls']
+        self.log.debug(q_data)
 
-        self.log.debug(all_queues)
+        return q_data
 
-        resource = boto3.resource('sqs', region_name=ApiServer.region)
+    def resolve_queue(self, q_name):
+        """Look up a queue URL by name, creating the queue if it does not exist"""
+
+        try:
+            url = self.sqs.get_queue_url(QueueName=q_name)['QueueUrl']
+            self.requests['get_url'] += 1
+            self.log.info('Queue ' + q_name + ' already exists')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in missing_queue_codes:
+                raise
+            self.log.info('Queue ' + q_name + ' does not exist, creating it')
+            url = self.sqs.create_queue(QueueName=q_name, Attributes=ApiServer.queue_attributes)['QueueUrl']
+            self.requests['create'] += 1
+
+        self.url_cache[q_name] = url
+        self.save_url_cache()
+
+        return url
+
+    def call(self, q_data, method, **kwargs):
+        """Make an SQS request against a queue, resolving the queue again if its URL has gone stale"""
+
+        if q_data['url'] is None:
+            q_data['url'] = self.resolve_queue(q_data['name'])
+
+        try:
+            started = time.perf_counter()
+            response = getattr(self.sqs, method)(QueueUrl=q_data['url'], **kwargs)
+            if method in self.rtt:
+                self.rtt[method].observe(time.perf_counter() - started)
+            return response
+        except ClientError as e:
+            if e.response['Error']['Code'] not in missing_queue_codes:
+                raise
+            self.log.warning('Queue ' + q_data['name'] + ' not found at cached URL, resolving again')
+            q_data['url'] = self.resolve_queue(q_data['name'])
+            return getattr(self.sqs, method)(QueueUrl=q_data['url'], **kwargs)
+
+    def register_metrics(self, registry):
+        for method, histogram in self.rtt.items():
+            registry.histogram('poolbot_sqs_rtt_seconds', 'SQS request round trip time', histogram, method=method)
+        for direction, histogram in self.batches.items():
+            registry.histogram('poolbot_sqs_batch_messages', 'Messages per SQS batch', histogram,
+                               direction=direction)
+        if self.spool is not None:
+            registry.gauge('poolbot_spool_pending', 'Messages spooled waiting to be sent', lambda: self.spool.pending)
+            registry.counter('poolbot_spool_dropped_total', 'Unsent messages dropped when the spool was full',
+                             lambda: self.spool.dropped)
+        for request in ('send', 'receive', 'delete'):
+            registry.counter('poolbot_sqs_requests_total', 'SQS requests made',
+                             functools.partial(self.requests.get, request, 0), request=request)
+
+    def purge(self):
+        """Throw away anything waiting in the read queue"""
+
+        self.call(self.read_q, 'purge_queue')
+        self.requests['purge'] += 1
+        self.log.info('Purged ' + self.read_q['name'])
+
+    def queue_msg(self, message):
+        """Hold a message until the next flush"""
+        self.pending.append(message)
 
-        found = False
-        for q in all_queues:
-            if q_data['name'] in q:
-                found = True
-                break
+    def send_msg(self, message):
+        """Send a message, along with anything else waiting to go"""
+        self.queue_msg(message)
+        return self.flush()
 
-        if found:
-            self.log.info('Queue ' + q_data['name'] + ' already exits, purging queue and returning instance')
-            # Get the queue. This returns an SQS.Queue instance
-            q_data['q'] = resource.get_queue_by_name(QueueName=q_data['name'])
-            q_data['q'].purge()
-            # AWS states that a purge can take up to 60 seconds, but we use less
-            sleep(10)
-        else:
-            self.log.info('Queue ' + q_data['name'] + ' does not exits creating instance')
-            # Create the queue. This returns an SQS.Queue instance
-            attributes = {'DelaySeconds': '0',
-                          'MessageRetentionPeriod': '60',
-                          'VisibilityTimeout': '30',
-                          'FifoQueue': 'true',
-                          'ContentBasedDeduplication' : 'true'
-                          }
-            resp = self.sqs.create_queue(QueueName=q_data['name'], Attributes=attributes)
-            self.log.debug(resp)
-            q_data['q'] = resource.get_queue_by_name(QueueName=q_data['name'])
+    def flush(self):
+        """Send all pending messages in as few batches as possible, returns the number sent"""
 
-        self.log.debug(q_data)
+        with self.flush_lock:
+            return self._flush()
 
-        return q_data
+    def _entries(self, bodies):
+        """send_message_batch entries for a list of message bodies"""
 
-    def send_msg(self, message):
+        timestamp = '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
 
-        # Send message to SQS queue
-        response = self.write_q['q'].send_message(
-            {
+        entries = []
+        for body in bodies:
+            entries.append({
+                'Id': str(len(entries)),
                 'MessageAttributes': {
                     'Timestamp': {
                         'DataType': 'String',
-                        'StringValue': '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
+                        'StringValue': timestamp
                     }
                 },
                 'MessageGroupId': self.write_q['name'],
-                'MessageBody': message
-            }
-        )
+                'MessageBody': body
+            })
+        return entries
+
+    def _flush(self):
+        sent = 0
+        while self.pending:
+            # Fill a batch up to the SQS entry count and payload size limits
+            bodies = []
+            size = 0
+            for message in self.pending[:ApiServer.max_batch]:
+                body = message if isinstance(message, str) else json.dumps(message, separators=(',', ':'))
+                if bodies and size + len(body) > ApiServer.max_batch_bytes:
+                    break
+                size += len(body)
+                bodies.append(body)
+            entries = self._entries(bodies)
+
+            response = self.call(self.write_q, 'send_message_batch', Entries=entries)
+            self.requests['send'] += 1
+            self.batches['send'].observe(len(entries))
+
+            failed = response.get('Failed', [])
+            for entry in failed:
+                self.log.error('Failed to send message: ' + str(entry))
+
+            del self.pending[:len(entries)]
+            sent += len(entries) - len(failed)
+
+            if failed:
+                # Keep the failures at the front of the queue for the next flush
+                self.pending[0:0] = [entries[int(entry['Id'])]['MessageBody'] for entry in failed]
+                break
+
+        self.log.debug('Sent ' + str(sent) + ' messages')
 
-        print(response['MessageId'])
+        return sent
 
-    def recieve_msg(self):
+    def recieve_msg(self, wait_time=None):
+        """Long poll the read queue, returns a list of message bodies (possibly empty)"""
 
-        message = ''
+        if wait_time is None:
+            wait_time = ApiServer.wait_time
 
-        # Receive message from SQS queue
-        response = self.read_q['q'].receive_messages(
+        # Receive messages from SQS queue, this returns as soon as anything arrives
+        response = self.call(
+                self.read_q, 'receive_message',
                 AttributeNames=['All'],
-                MaxNumberOfMessages=1,
+                MaxNumberOfMessages=ApiServer.max_batch,
                 MessageAttributeNames=['All'],
-                VisibilityTimeout=0,
-                WaitTimeSeconds=0
+                WaitTimeSeconds=wait_time
         )
+        self.requests['receive'] += 1
+
+        messages = response.get('Messages', [])
+        if not messages:
+            return []
+        self.batches['receive'].observe(len(messages))
+
+        # Delete received messages from queue
+        response = self.call(
+                self.read_q, 'delete_message_batch',
+                Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                         for i, message in enumerate(messages)]
+        )
+        self.requests['delete'] += 1
 
-        self.log.info(response)
+        for entry in response.get('Failed', []):
+            self.log.error('Failed to delete message: ' + str(entry))
 
-        if response:
-            message = response['Messages']
-            receipt_handle = message['ReceiptHandle']
+        self.log.info('Received and deleted ' + str(len(messages)) + ' messages')
 
-            # Delete received message from queue
-            self.sqs.delete_message(
-                    QueueUrl=self.read_q['q'].url,
-                    ReceiptHandle=receipt_handle
-            )
-            self.log.info('Received and deleted message: %s' % message)
+        if self.discard_stale:
+            fresh = [message for message in messages
+                     if int(message.get('Attributes', {}).get('SentTimestamp', 0)) / 1000 >= self.started]
+            if len(fresh) != len(messages):
+                self.log.info('Dropped ' + str(len(messages) - len(fresh)) + ' messages sent before startup')
+            messages = fresh
 
-        return message
+        return [message['Body'] for message in messages]
 
-    def process_msg(self):
+    async def process_msg(self, handler=None):
+        """Receive messages until cancelled, passing each body to handler(body)"""
+        loop = asyncio.get_event_loop()
+        backoff = Backoff(initial=1.0, maximum=60.0)
         while True:
-            msg = self.recieve_msg()
-            if msg:
-                self.log.info('Recieved msg:' + msg)
+            # boto3 blocks, so the long poll runs on the loop's executor
+            try:
+                msgs = await loop.run_in_executor(None, self.recieve_msg)
+                backoff.reset()
+            except Exception as e:
+                self.log.warning('Unable to receive messages: ' + str(e))
+                await asyncio.sleep(backoff.next())
+                continue
+            if msgs:
+                for msg in msgs:
+                    self.log.info('Recieved msg:' + msg)
+                    if handler is not None:
+                        # One bad message must not end the receive loop
+                        try:
+                            handler(msg)
+                        except Exception:
+                            self.log.exception('Unable to handle message ' + msg)
             else:
                 self.log.debug('No message recieved')
 
-            sleep(30)
\ No newline at end of file
+    async def publish(self, message):
+        """Send a message, through the spool if there is one so it survives the network being down"""
+        if self.spool is None:
+            loop = asyncio.get_event_loop()
+            self.queue_msg(message)
+            await loop.run_in_executor(None, self.flush)
+            return
+
+        body = message if isinstance(message, str) else json.dumps(message, separators=(',', ':'))
+        self.spool.append(body)
+        if self.spooled is not None:
+            self.spooled.set()
+
+    def send_spooled(self):
+        """Send one batch from the spool, returns the number of messages sent"""
+
+        self.spool.sync()
+        messages, position = self.spool.peek(ApiServer.max_batch, ApiServer.max_batch_bytes)
+        if not messages:
+            return 0
+
+        entries = self._entries([message.decode('utf-8') for message in messages])
+        response = self.call(self.write_q, 'send_message_batch', Entries=entries)
+        self.requests['send'] += 1
+        self.batches['send'].observe(len(entries))
+
+        failed = response.get('Failed', [])
+        if failed:
+            # The spool can only be consumed in order, so the whole batch goes again. Content based
+            # deduplication on the FIFO queue drops the ones that did get through.
+            for entry in failed:
+                self.log.error('Failed to send message: ' + str(entry))
+            raise IOError(str(len(failed)) + ' of ' + str(len(entries)) + ' spooled messages failed')
+
+        self.spool.commit(position, len(messages))
+        return len(messages)
+
+    async def drain(self):
+        """Send spooled messages as they arrive, backing off while the network is down"""
+        loop = asyncio.get_event_loop()
+        backoff = Backoff(initial=1.0, maximum=60.0)
+        self.spooled = asyncio.Event()
+        while True:
+            if not self.spool.pending:
+                self.spooled.clear()
+                await self.spooled.wait()
+
+            try:
+                # Shielded so cancelling us leaves the batch to finish, wait_sent() waits for it
+                self.sending = loop.run_in_executor(None, self.send_spooled)
+                await asyncio.shield(self.sending)
+                backoff.reset()
+            except Exception as e:
+                delay = backoff.next()
+                self.log.warning('Unable to send {0} spooled messages, retrying in {1:.0f}s: {2}'.format(
+                    self.spool.pending, delay, e))
+                await asyncio.sleep(delay)
+
+    async def wait_sent(self):
+        """Wait for a batch drain() already has on its way out of the spool, call before closing the spool"""
+        if self.sending is not None and not self.sending.done():
+            try:
+                await self.sending
+            except Exception as e:
+                self.log.warning('Spooled batch not sent, it stays spooled: ' + str(e))
+            self.sending = None
@@ -4,42 +4,140 @@
 
 from __future__ import (division, print_function)
 
+import asyncio
 import logging
-import string
 import serial
 import struct
-import sys
 import time
 import os
 
+from frameDecoderClass import FrameDecoder, Frame
+from frameEncoderClass import FrameEncoder
+from captureClass import CaptureWriter
+from loggingUtils import HexBytes
+from screenClass import Screen
+from stateClass import PoolState
+from keypressClass import KeyScheduler
+from ackClass import AckEngine
+from reconnectClass import ReconnectManager
+
+
+# Controller command: (name of the Aqualink method handling it, struct for the fixed arguments it starts with)
+handlers = {}
+
+
+def handles(cmd, fmt=''):
+    """Register an Aqualink method as the handler for a controller command.
+    The handler is called with the unpacked fixed arguments followed by a memoryview of the rest."""
+    def register(method):
+        handlers[cmd] = (method.__name__, struct.Struct('<' + fmt))
+        return method
+    return register
+
 
 class Aqualink:
 
     # ASCII constants
-    NUL = '\x00'
-    DLE = '\x10'
-    STX = '\x02'
-    ETX = '\x03'
+    NUL = 0x00
+    DLE = 0x10
+    STX = 0x02
+    ETX = 0x03
 
     # Address of Aqualink controller
-    masterAddr = '\x00'
+    masterAddr = 0x00
+
+    # Command the controller probes us with when it has nothing else to send
+    probeCmd = 0x00
+
+    # Command we reply to the controller with, and the ACK we send when no key is pressed
+    ackCmd = 0x01
+    idleAck = b'\x40\x00'
+
+    # Key codes sent in the ACK
+    keyToAck = {'up': 0x06, 'down': 0x05, 'back': 0x02, 'select': 0x04, 'but1': 0x01, 'but2': 0x03}
 
     # Address of PDA remote to emulate
-    ID = '60'
+    pdaAddr = 0x60
+
+    # How often to log decoder throughput, in seconds
+    reportInterval = 60
+
+    # Seconds to wait for the controller to take a key, and for the screen to change after it
+    keyTimeout = 5
+
+    # Most back presses it can take to get to the home screen
+    maxBack = 5
+
+    # Most items to scroll through looking for a menu entry
+    maxMenuItems = 20
+
+    # Menu items leading from the home screen to the equipment list
+    equipmentMenu = ('EQUIPMENT ON/OFF',)
+
+    # Line numbers the controller uses for the time and temperature lines
+    lineCodes = {0x40: 1, 0x82: 2}
 
     def __str__(self):
         return self.__class__.__name__ + ' Controller'
 
-    def __init__(self, serial_dev):
+    def __init__(self, serial_dev, port=None):
 
         self.serial_dev = serial_dev
-        self.port = None
+        self.port = port
 
         self.log = logging.getLogger(self.__class__.__name__)
 
         self.log.info('Init')
         self.log.debug('Using serial device: ' + self.serial_dev)
 
+        # A port can be handed in, e.g. a capture replay, otherwise open the serial device
+        if self.port is None:
+            self._open()
+
+        # Frames are pulled off the port in bulk by the decoder
+        self.decoder = FrameDecoder(self.port)
+        self.frames = iter(self.decoder)
+        self.encoder = FrameEncoder()
+        self.keys = KeyScheduler(mark=lambda: self.screen.version)
+        self.acks = AckEngine(self.port, self.encoder, self.keys, Aqualink.masterAddr, Aqualink.ackCmd,
+                              Aqualink.keyToAck.values())
+        self.lastReport = time.time()
+        self.capture = None
+
+        # Reopens the port if it drops out, from the event loop once attached to one
+        self.link = ReconnectManager(self._openPort)
+        self.loop = None
+        self.readerFd = None
+        self.reconnecting = None
+
+        # Handler and argument struct for each controller command
+        self.dispatch = {}
+        for cmd, (name, fmt) in handlers.items():
+            self.dispatch[cmd] = (getattr(self, name), fmt)
+
+        # Controller commands processMessage did not recognise, or that were too short to unpack
+        self.unknownCmds = 0
+        self.shortCmds = 0
+
+        # What the controller has drawn on our screen, and the pool state read from it
+        self.screen = Screen()
+        self.state = PoolState(self.screen)
+
+        # Set when the controller probes after drawing, for anyone waiting on the result of a keypress
+        self.screenEvent = None
+        self.settledVersion = 0
+
+        # Key paths from the home screen to menu items we have already found, by tuple of item labels
+        self.menuPaths = {}
+
+        # Held while anything walks the menus, so key presses from different callers don't interleave.
+        # Made by the first attach() on the loop servicing the port, which is where every caller runs, and kept
+        # through reconnects so a caller holding it keeps out everyone else
+        self.menuLock = None
+
+    def _open(self):
+        """Open the serial device, raising SerialException if it is not there or can't be opened"""
+
         # Check to see if the port exists, if we just booted it may take a little time to be available
         for i in range(5):
             if os.path.exists(self.serial_dev):
@@ -48,244 +146,453 @@ class Aqualink:
                 time.sleep(2)
 
         # Final check to make sure its there
-        if os.path.exists(self.serial_dev):
-            self.log.critical(self.serial_dev + ' does not exist')
+        if not os.path.exists(self.serial_dev):
+            raise serial.SerialException(self.serial_dev + ' does not exist')
 
-        self.port = serial.Serial(self.serial_dev, baudrate=9600,
-                                      bytesize=serial.EIGHTBITS,
-                                      parity=serial.PARITY_NONE,
-                                      stopbits=serial.STOPBITS_ONE,
-                                      timeout=None)
+        self.port = self._openPort()
 
-        if self.port is None:
-            self.log.critical('Unable to create port')
+    def _openPort(self):
+        """Open the serial device, raising SerialException if it is not there"""
 
+        return serial.Serial(self.serial_dev, baudrate=9600,
+                             bytesize=serial.EIGHTBITS,
+                             parity=serial.PARITY_NONE,
+                             stopbits=serial.STOPBITS_ONE,
+                             timeout=None)
 
-    def _sync(self):
-        """Sync with the message bus"""
+    def _usePort(self, port):
+        """Switch everything that talks to the port over to a new one"""
 
-        # Init the msg so we enter the loop below
-        data = Aqualink.NUL + Aqualink.NUL
+        self.port = port
+        self.decoder.port = port
+        self.acks.port = port
 
-        # Skip bytes until synchronized with the start of a message
-        while (data[-1] != Aqualink.STX) or (data[-2] != Aqualink.DLE):
-            data += self.port.read(1)
+    def _portLost(self, error):
+        """Close a port that has failed, dropping any partial frame so we resync cleanly on the new one"""
 
-            if self.debugRawMsg:
-                self.debugRaw(data[-1])
+        self.link.lost(error)
+        if self.loop is not None:
+            self.detach(self.loop)
+        try:
+            self.port.close()
+        except ReconnectManager.errors:
+            pass
+        self.decoder.reset()
 
-        self.log.info('Init complete')
+    async def _reconnect(self):
+        """Reopen the port with backoff and start servicing it again"""
 
+        self._usePort(await self.link.open())
+        self.attach(self.loop)
+        self.reconnecting = None
 
     def readMsg(self):
         """ Read the next valid message from the serial port.
-        Parses and returns the destination address, command, and arguments as a
-        tuple."""
+        Returns a Frame holding its own copy of the arguments."""
 
         while True:
-            dleFound = False
-            # read what is probably the DLE STX
             try:
-                self.msg += self.port.read(2)
-            except serial.SerialException:
-                self.msg += chr(0) + chr(0)
-                self._open()
-            if debugRaw:
-                self.debugRaw(self.msg[-2])
-                self.debugRaw(self.msg[-1])
-            while len(self.msg) < 2:
-                self.msg += chr(0)
-            while (self.msg[-1] != Aqualink.ETX) or (not dleFound) or (len(self.msg) > 128):
-                # read until DLE ETX
-                try:
-                    if (self.port == None):
-                        return {'dest': "ff", 'cmd': "ff", 'args': ""}
-                    self.msg += self.port.read(1)
-                except serial.SerialException:
-                    self.msg += chr(0)
-                    self._open()
-                if debugRaw:
-                    self.debugRaw(self.msg[-1])
-                if self.msg[-1] == Aqualink.DLE:
-                    # \x10 read, tentatively is a DLE
-                    dleFound = True
-                if (self.msg[-2] == Aqualink.DLE) and (self.msg[-1] == Aqualink.NUL) and dleFound:
-                    # skip a NUL following a DLE
-                    self.msg = self.msg[:-1]
-                    # it wasn't a DLE after all
-                    dleFound = False
-                    # skip any NULs between messages
-            self.msg = self.msg.lstrip(Aqualink.NUL)
-            # parse the elements of the message
-            dlestx = self.msg[0:2]
-            dest = self.msg[2:3]
-            cmd = self.msg[3:4]
-            args = self.msg[4:-3]
-            if cmd.encode("hex") == "04":
-                ascii_args = " (" + filter(lambda x: x in string.printable, args) + ")"
-            else:
-                ascii_args = ""
-            checksum = self.msg[-3:-2]
-            dleetx = self.msg[-2:]
-            self.msg = ""
-            debugMsg = "IN dest=" + dest.encode("hex") + " cmd=" + cmd.encode("hex") + " args=" + args.encode(
-                "hex") + ascii_args
-            # stop reading if a message with a valid checksum is read
-            if self.checksum(dlestx + dest + cmd + args) == checksum:
-                if debugData:
-                    if cmd.encode("hex") != "00" \
-                            and cmd.encode("hex") != "01" \
-                            and cmd.encode("hex") != "02":
-                        if debugAll or dest.encode("hex") == "60":  # only log coms from master and PDA
-                            log(debugMsg)
-                if args == None:
-                    args = ""
-                return {'dest': dest.encode("hex"), 'cmd': cmd.encode("hex"), 'args': args}
-            else:
-                if debugData:
-                    log(debugMsg, "*** bad checksum ***")
-
-    def sendMsg(self, (dest, cmd, args)):
+                body = next(self.frames)
+                break
+            except ReconnectManager.errors as e:
+                # The generator is finished once it raises, so start a new one on the new port
+                self._portLost(e)
+                self._usePort(self.link.open_blocking())
+                self.frames = iter(self.decoder)
+
+        if self.link.lost_at is not None:
+            self.link.recovered()
+        frame = Frame(body[0], body[1], body[2:].tobytes())
+        self._logFrame(frame)
+        self.report()
+
+        return frame
+
+    def _logFrame(self, frame):
+        """ Log a frame at debug, the hex is only built if the record is written out, on the logging thread."""
+
+        # Only log coms between the master and the PDA, and skip the probes and status chatter
+        if frame.dest == Aqualink.pdaAddr and frame.cmd > 0x02 and self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('IN dest=%02x cmd=%02x args=%s', frame.dest, frame.cmd, HexBytes(frame.args,
+                                                                                             frame.cmd == 0x04))
+
+    def attach(self, loop):
+        """ Service the serial port from an asyncio event loop instead of blocking reads."""
+        self.loop = loop
+        if self.menuLock is None:
+            self.menuLock = asyncio.Lock()
+        self.port.timeout = 0
+        self.readerFd = self.port.fileno()
+        loop.add_reader(self.readerFd, self.poll)
+        self.log.info('Attached to event loop')
+
+    def detach(self, loop):
+        """ Stop servicing the serial port from the event loop."""
+        if self.readerFd is not None:
+            loop.remove_reader(self.readerFd)
+            self.readerFd = None
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+            self.reconnecting = None
+
+    def poll(self):
+        """ Called by the event loop when the port is readable.
+        Decodes everything waiting and answers frames addressed to us straight away."""
+        try:
+            self.decoder.fill()
+            for frame in self.decoder.frames():
+                self.handleFrame(frame)
+        except ReconnectManager.errors as e:
+            self._portLost(e)
+            self.reconnecting = self.loop.create_task(self._reconnect())
+        self.screen.flush()
+        self.report()
+
+    def handleFrame(self, body):
+        """ Answer a frame addressed to us before doing anything else with it, then process it."""
+        if body[0] != Aqualink.pdaAddr:
+            return
+
+        self.acks.ack(self.decoder.received)
+        if self.link.lost_at is not None:
+            # The controller is talking to us again after a port fault
+            self.link.recovered()
+
+        frame = Frame.from_body(body)
+        self._logFrame(frame)
+        self.processMessage(frame)
+
+    def report(self):
+        """ Log decoder throughput and ACK latency every reportInterval seconds."""
+        now = time.time()
+        if now - self.lastReport < Aqualink.reportInterval:
+            return
+        self.lastReport = now
+
+        stats = self.decoder.stats()
+        self.log.info('Decoder: {0:.1f} frames/s, {1} bad checksums, {2} resyncs'.format(
+            self.decoder.throughput(), stats['bad_checksums'], stats['resyncs']))
+        if self.acks.latency.count:
+            self.log.info(self.acks.latency.summary() + ', {0} over {1:.0f}ms'.format(
+                self.acks.late, AckEngine.deadline * 1000))
+
+    def registerMetrics(self, registry, **labels):
+        """ Report bus, decoder, ACK and keypress numbers to a metrics registry."""
+        decoder = self.decoder
+        registry.counter('poolbot_frames_total', 'Frames decoded off the bus', lambda: decoder.frame_count, **labels)
+        registry.counter('poolbot_bus_bytes_total', 'Bytes read off the bus', lambda: decoder.byte_count, **labels)
+        # rate() only reads the window, throughput() starts a new one and is left to report()
+        registry.gauge('poolbot_frames_per_second', 'Frames decoded per second over the current report window',
+                       decoder.rate, **labels)
+        registry.counter('poolbot_bad_checksums_total', 'Frames dropped for a bad checksum',
+                         lambda: decoder.bad_checksums, **labels)
+        registry.counter('poolbot_resyncs_total', 'Times the decoder lost and regained frame sync',
+                         lambda: decoder.resyncs, **labels)
+        registry.counter('poolbot_unknown_commands_total', 'Controller commands not recognised',
+                         lambda: self.unknownCmds, **labels)
+        registry.counter('poolbot_short_commands_total', 'Controller commands too short to unpack',
+                         lambda: self.shortCmds, **labels)
+        registry.histogram('poolbot_ack_latency_seconds', 'Time from a frame arriving to our reply being written',
+                           self.acks.latency, **labels)
+        registry.counter('poolbot_late_acks_total', 'Replies written after the ACK deadline',
+                         lambda: self.acks.late, **labels)
+        registry.counter('poolbot_serial_faults_total', 'Times the serial port dropped out',
+                         lambda: self.link.faults, **labels)
+        registry.histogram('poolbot_serial_recover_seconds', 'Time from a serial fault to the controller talking to us',
+                           self.link.recover_time, **labels)
+        registry.gauge('poolbot_key_queue_depth', 'Keypresses waiting to be sent', self.keys.depth, **labels)
+
+    def sendMsg(self, msg):
         """ Send a message.
-        The destination address, command, and arguments are specified as a tuple."""
-        msg = Aqualink.DLE + Aqualink.STX + dest + cmd + args
-        msg = msg + self.checksum(msg) + Aqualink.DLE + Aqualink.ETX
-
-        if debugData:
-            if args.encode("hex") != "4000":  # don't log typical ACKs
-                debugMsg = "OUT dest=" + dest.encode("hex") + " cmd=" + \
-                           cmd.encode("hex") + " args=" + args.encode("hex")
-                log(debugMsg)
-
-        for i in range(2, len(msg) - 2):
-            # if a byte in the message has the value \x10 insert a NUL after it
-            if msg[i] == Aqualink.DLE:
-                msg = msg[0:i + 1] + Aqualink.NUL + msg[i + 1:]
-        n = self.port.write(msg)
-
-    def checksum(self, msg):
-        """ Compute the checksum of a string of bytes."""
-        return struct.pack("!B", reduce(lambda x, y: x + y, map(ord, msg)) % 256)
+        The destination address, command (ints) and arguments (bytes) are specified as a tuple."""
+        dest, cmd, args = msg
+        frame = self.encoder.encode(dest, cmd, args)
 
-    def debugRaw(self, byte):
-        """ Debug raw serial data."""
-        self.debugRawMsg += byte
-        if ((len(self.debugRawMsg) == 48) or (byte == Aqualink.ETX)):
-            log(self.debugRawMsg.encode("hex"))
-            self.debugRawMsg = ""
+        if args != Aqualink.idleAck and self.log.isEnabledFor(logging.DEBUG):  # don't log typical ACKs
+            self.log.debug('OUT dest=%02x cmd=%02x args=%s', dest, cmd, HexBytes(args))
 
+        self.port.write(frame)
 
-    def sendAck(self, i):
-        """Controller talked to us, send back our last keypress."""
-        ackstr = "40" + self.nextAck  # was 8b before, PDA seems to be 400# for keypresses (4001-4006)
-        i.sendMsg((chr(0), chr(1), ackstr.decode("hex")))
-        self.nextAck = "00"
+    def checksum(self, msg):
+        """ Compute the checksum of a string of bytes."""
+        return struct.pack("!B", sum(msg) & 0xff)
+
+    def startCapture(self, filename):
+        """ Record raw serial data to a capture file."""
+        self.stopCapture()
+        self.capture = CaptureWriter(filename)
+        self.decoder.tap = self.capture.write
+
+    def stopCapture(self):
+        """ Stop recording raw serial data."""
+        if self.capture is not None:
+            self.decoder.tap = None
+            self.capture.close()
+            self.capture = None
+
+    def sendAck(self):
+        """Controller talked to us, send back our next keypress."""
+        # was 8b before, PDA seems to be 400# for keypresses (4001-4006)
+        self.acks.ack()
 
     def setNextAck(self, nextAck):
-        """Set the value we will send on the next ack, but don't send yet."""
-        self.nextAck = nextAck
+        """Queue a raw key code to send on a following ack."""
+        self.keys.push(nextAck)
 
     def sendKey(self, key):
-        """Send a key (text) on the next ack."""
-        keyToAck = {'up': "06", 'down': "05", 'back': "02", 'select': "04", 'but1': "01", 'but2': "03"}
-        if key in keyToAck.keys():
-            self.setNextAck(keyToAck[key])
-
-    def processMessage(self, ret, i):
-        """Process message from a controller, updating internal state."""
-        if ret['cmd'] == "09":  # Clear Screen
-            # What do the args mean?  Ignore for now
-            if (ord(ret['args'][0:1]) == 0):
-                self.cls()
-            else:  # May be a partial clear?
-                self.cls()
-            # print "cls: "+ret['args'].encode("hex")
-            self.sendAck(i)
-        elif ret['cmd'] == "0f":  # Scroll Screen
-            start = ord(ret['args'][:1])
-            end = ord(ret['args'][1:2])
-            direction = ord(ret['args'][2:3])
-            self.scroll(start, end, direction)
-            self.sendAck(i)
-        elif ret['cmd'] == "04":  # Write a line
-            line = ord(ret['args'][:1])
-            if line == 64: line = 1  # time (hex=40)
-            if line == 130: line = 2  # temp (hex=82)
-            offset = 1
-            text = ""
-            while (ret['args'][offset:offset + 1].encode("hex") != "00") and (offset < len(ret['args'])):
-                text += ret['args'][offset:offset + 1]
-                offset = offset + 1
-            self.writeLine(line, text)
-            self.sendAck(i)
-        elif ret['cmd'] == "05":  # Initial handshake?
-            # ??? After initial turn on get this, rela box responds custom ack
-            #            i.sendMsg( (chr(0), chr(1), "0b00".decode("hex")) )
-            self.sendAck(i)
-        elif ret['cmd'] == "00":  # PROBE
-            self.sendAck(i)
-        elif ret['cmd'] == "02":  # Status?
-            self.setStatus(ret['args'].encode("hex"))
-            self.sendAck(i)
-        elif ret['cmd'] == "08":  # Invert an entire line
-            self.invertLine(ord(ret['args'][:1]))
-            self.sendAck(i)
-        elif ret['cmd'] == "10":  # Invert just some chars on a line
-            self.invertChars(ord(ret['args'][:1]), ord(ret['args'][1:2]), ord(ret['args'][2:3]))
-            self.sendAck(i)
-        else:
-            log("UNKNOWN MESSAGE: cmd=" + ret['cmd'] + " args=" + ret['args'].encode("hex"))
-            self.sendAck(i)
-
-
-
-    def processMessage(ret, i):
-        """Process message from a controller, updating internal state."""
-        if ret['cmd'] == "09":  # Clear Screen
-            self.sendAck(i)
-        elif ret['cmd'] == "0f":  # Scroll Screen
-            start = ord(ret['args'][:1])
-            end = ord(ret['args'][1:2])
-            direction = ord(ret['args'][2:3])
-            self.scroll(start, end, direction)
-            self.sendAck(i)
-        elif ret['cmd'] == "04":  # Write a line
-            line = ord(ret['args'][:1])
-            if line == 64: line = 1  # time (hex=40)
-            if line == 130: line = 2  # temp (hex=82)
-            offset = 1
-            text = ""
-            while (ret['args'][offset:offset + 1].encode("hex") != "00") and (offset < len(ret['args'])):
-                text += ret['args'][offset:offset + 1]
-                offset = offset + 1
-            self.writeLine(line, text)
-            self.sendAck(i)
-        elif ret['cmd'] == "05":  # Initial handshake?
-            # ??? After initial turn on get this, rela box responds custom ack
-            #            i.sendMsg( (chr(0), chr(1), "0b00".decode("hex")) )
-            self.sendAck(i)
-        elif ret['cmd'] == "00":  # PROBE
-            self.sendAck(i)
-        elif ret['cmd'] == "02":  # Status?
-            self.setStatus(ret['args'].encode("hex"))
-            self.sendAck(i)
-        elif ret['cmd'] == "08":  # Invert an entire line
-            self.invertLine(ord(ret['args'][:1]))
-            self.sendAck(i)
-        elif ret['cmd'] == "10":  # Invert just some chars on a line
-            self.invertChars(ord(ret['args'][:1]), ord(ret['args'][1:2]), ord(ret['args'][2:3]))
-            self.sendAck(i)
-        else:
-            log("UNKNOWN MESSAGE: cmd=" + ret['cmd'] + " args=" + ret['args'].encode("hex"))
-            self.sendAck(i)
-
-    def log_msg(*args):
-        message = "%-16s " % args[0]
-        for arg in args[1:]:
-            message += arg.__str__() + " "
-        logmsg = time.asctime(time.localtime()) + ": " + message
-        print(logmsg)
-        log.info(logmsg)
-
-
-
+        """Send a key (text) on the next free ack."""
+        if key in Aqualink.keyToAck:
+            self.setNextAck(Aqualink.keyToAck[key])
+
+    async def pressKeys(self, keys):
+        """Press a sequence of keys, one per probe, and wait for the screen to change after the last one.
+        Returns the number of probe cycles it took to send them."""
+        codes = [Aqualink.keyToAck[key] for key in keys]
+        future = self.keys.submit(codes)
+        try:
+            cycles, version = await asyncio.wait_for(future, Aqualink.keyTimeout + len(codes))
+        except asyncio.TimeoutError:
+            self.log.warning('Controller did not take keys ' + str(keys))
+            raise
+        if not await self.waitForScreen(version):
+            self.log.debug('Screen did not change after ' + str(keys))
+        return cycles
+
+    async def pressKey(self, key):
+        """Press a key and wait until the controller has taken it and redrawn the screen."""
+        return await self.pressKeys([key])
+
+    async def waitForScreen(self, version, timeout=None):
+        """Wait for the controller to finish redrawing after the given screen version, returns False on timeout."""
+        if self.screenEvent is None:
+            self.screenEvent = asyncio.Event()
+        deadline = time.time() + (Aqualink.keyTimeout if timeout is None else timeout)
+        while self.settledVersion <= version:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.screenEvent.clear()
+            try:
+                await asyncio.wait_for(self.screenEvent.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _screenSettled(self):
+        self.settledVersion = self.screen.version
+        if self.screenEvent is not None:
+            self.screenEvent.set()
+
+    def isHome(self):
+        """Is the home screen (with the temperatures) showing."""
+        lines = self.screen.lines()
+        for row in range(len(lines) - 1):
+            if PoolState.temp_labels.search(lines[row]) and '`' in lines[row + 1]:
+                return True
+        return False
+
+    async def goHome(self):
+        """Back out of any menus to the home screen."""
+        for i in range(Aqualink.maxBack):
+            if self.isHome():
+                return True
+            await self.pressKey('back')
+        return self.isHome()
+
+    def _isShowing(self, label):
+        """Is an item starting with label highlighted, or is label the page title."""
+        row = self.screen.highlighted()
+        if row is not None and self.screen.line(row).strip().startswith(label):
+            return True
+        return self.screen.line(0).strip().startswith(label)
+
+    async def _findItem(self, label):
+        """Move the highlight down to the item starting with label, returns the keys pressed or None."""
+        keys = []
+        for i in range(Aqualink.maxMenuItems):
+            row = self.screen.highlighted()
+            if row is not None and self.screen.line(row).strip().startswith(label):
+                return keys
+            await self.pressKey('down')
+            keys.append('down')
+        return None
+
+    async def selectItem(self, labels):
+        """Starting from the home screen, highlight and select each menu item in labels in turn.
+        The key path to each target is remembered, so repeats are sent in one go without looking at the screen
+        between keys. Returns True if the target was reached."""
+        async with self.menuLock:
+            return await self._selectItem(labels)
+
+    async def _selectItem(self, labels):
+        """selectItem() with the menu lock already held."""
+        labels = tuple(labels)
+        start = time.time()
+
+        if not await self.goHome():
+            self.log.warning('Unable to get to the home screen')
+            return False
+
+        path = self.menuPaths.get(labels)
+        if path is not None:
+            cycles = await self.pressKeys(path)
+            if self._isShowing(labels[-1]):
+                self.log.info('Selected {0} in {1} probes, {2:.3f}s'.format(
+                    ' > '.join(labels), cycles, time.time() - start))
+                return True
+            # Menus have moved, find the way again
+            self.log.info('Cached path to ' + ' > '.join(labels) + ' is stale')
+            del self.menuPaths[labels]
+            if not await self.goHome():
+                return False
+
+        path = []
+        for label in labels:
+            keys = await self._findItem(label)
+            if keys is None:
+                self.log.warning('Menu item ' + label + ' not found')
+                return False
+            await self.pressKey('select')
+            path += keys + ['select']
+
+        self.menuPaths[labels] = path
+        self.log.info('Found {0} with keys {1} in {2:.3f}s'.format(' > '.join(labels), path, time.time() - start))
+        return True
+
+    async def setEquipment(self, name, on):
+        """Turn equipment on or off by selecting it in the equipment menu if it is not already in that state.
+        name is the state name, e.g. spa_mode. Returns the state afterwards, None if it could not be reached."""
+        async with self.menuLock:
+            if self.state.get(name) == on:
+                return on
+            label = name.upper().replace('_', ' ')
+            if not await self._selectItem(Aqualink.equipmentMenu + (label,)):
+                return None
+            return self.state.get(name)
+
+    async def _readEquipment(self):
+        """Scroll through the equipment menu so every on/off state on it is read. Returns False if it was not reached."""
+        if not await self._selectItem(Aqualink.equipmentMenu):
+            return False
+        seen = set()
+        for i in range(Aqualink.maxMenuItems):
+            self.state.refresh(self.screen)
+            row = self.screen.highlighted()
+            item = self.screen.line(row).strip() if row is not None else None
+            # Stop when the highlight stays put at the bottom or wraps round to an item we have had
+            if item is None or item in seen:
+                break
+            seen.add(item)
+            await self.pressKey('down')
+        return True
+
+    async def readAll(self):
+        """Snapshot of every sensor and equipment state, read from the home screen and the equipment menu in one
+        pass, ending back on the home screen.
+        Includes values last seen on other pages, state.updated has when each one was read."""
+        async with self.menuLock:
+            equipment = False
+            try:
+                home = await self.goHome()
+                if home:
+                    self.state.refresh(self.screen)
+                    equipment = await self._readEquipment()
+                    await self.goHome()
+            except asyncio.TimeoutError:
+                home = False
+            if not home:
+                self.log.warning('Unable to get to the home screen, snapshot may be stale')
+            elif not equipment:
+                self.log.warning('Unable to read the equipment menu, equipment states may be stale')
+            return dict(self.state.values)
+
+    def get_temp(self, sensor):
+        """Last temperature seen for a sensor (air, pool or spa)."""
+        return self.state.get(sensor + '_temp')
+
+    def cls(self):
+        """Clear the screen."""
+        self.screen.cls()
+
+    def scroll(self, start, end, direction):
+        """Scroll lines start to end up or down one line."""
+        self.screen.scroll(start, end, direction)
+
+    def writeLine(self, line, text):
+        """Write text to a line of the screen."""
+        self.screen.write_line(line, text)
+
+    def invertLine(self, line):
+        """Highlight a line of the screen."""
+        self.screen.invert_line(line)
+
+    def invertChars(self, line, start, end):
+        """Highlight some characters on a line of the screen."""
+        self.screen.invert_chars(line, start, end)
+
+    def setStatus(self, status):
+        """Keep the status bytes sent by the controller."""
+        self.screen.set_status(status)
+
+    def registerHandler(self, cmd, handler, fmt=''):
+        """Handle a controller command on this instance, replacing any existing handler.
+        handler is called with the arguments unpacked by struct format fmt, followed by a memoryview of the rest."""
+        self.dispatch[cmd] = (handler, struct.Struct('<' + fmt))
+
+    def processMessage(self, frame):
+        """Process a frame from the controller, updating internal state.
+        The ACK has already been sent by the time this is called."""
+        entry = self.dispatch.get(frame.cmd)
+        if entry is None:
+            self.unknownCmds += 1
+            self.log.warning('UNKNOWN MESSAGE: cmd=%02x args=%s', frame.cmd, HexBytes(frame.args))
+            return
+
+        handler, fmt = entry
+        args = frame.args
+        if len(args) < fmt.size:
+            self.shortCmds += 1
+            self.log.warning('SHORT MESSAGE: cmd=%02x args=%s', frame.cmd, HexBytes(args))
+            return
+
+        handler(*fmt.unpack_from(args), args[fmt.size:])
+
+    @handles(0x00)
+    def _onProbe(self, rest):
+        """ The controller only probes once it has finished drawing."""
+        self.screen.flush()
+        self._screenSettled()
+
+    @handles(0x02)
+    def _onStatus(self, rest):
+        self.setStatus(bytes(rest))
+
+    @handles(0x04, 'B')
+    def _onWriteLine(self, line, rest):
+        text = bytes(rest)
+        end = text.find(b'\x00')
+        if end >= 0:
+            text = text[:end]
+        self.writeLine(Aqualink.lineCodes.get(line, line), text)
+
+    @handles(0x05)
+    def _onHandshake(self, rest):
+        """ Initial handshake? After initial turn on get this, rela box responds custom ack."""
+        pass
+
+    @handles(0x08, 'B')
+    def _onInvertLine(self, line, rest):
+        self.invertLine(line)
+
+    @handles(0x09)
+    def _onClear(self, rest):
+        """ What do the args mean? A non zero one may be a partial clear, treated as a full one for now."""
+        self.cls()
+
+    @handles(0x0f, 'BBB')
+    def _onScroll(self, start, end, direction, rest):
+        self.scroll(start, end, direction)
+
+    @handles(0x10, 'BBB')
+    def _onInvertChars(self, line, start, end, rest):
+        self.invertChars(line, start, end)
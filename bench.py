@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+"""
+Benchmarks the bus framing, checksum, encoding, dispatch and screen code plus the SQS send and receive path against
+a synthetic or recorded corpus, and fails if anything has got slower or uses more memory than the saved baseline.
+
+No baseline is shipped, the numbers only mean anything on the machine they were measured on. The first step is to
+save one there with -s before making a performance change, then run again without -s after it. A run with no
+baseline for its corpus fails.
+"""
+
+from __future__ import (division, print_function)
+
+import sys
+import os
+import getopt
+import time
+
+from loggingUtils import log_setup, shutdown_logging
+from benchmarkClass import BenchmarkRunner, synthetic_corpus, recorded_corpus, load_baseline, save_baseline
+
+# Configuration
+
+# Find our current dir and set our base dir
+script_name = os.path.basename(__file__)
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Init our cmd line args
+loggingLevel = ''
+captureFile = ''
+frames = 5000
+cases = None
+# Results only hold on the machine they were measured on, so the baseline lives with the other local state, not in conf
+baselineFile = os.path.join(base_dir, 'cache', 'benchmark.json')
+save = False
+threshold = 0.25
+repeats = 5
+
+
+# Usage method
+def usage():
+    print('Usage: ./' + script_name + ' [-f <capture file>] [-n frames] [-c cases] [-b baseline] [-s] [-t threshold] '
+          '[-r repeats] [-d debug level]')
+    print('  -f  use a recorded capture as the corpus, otherwise -n simulated frames')
+    print('  -c  comma separated cases: ' + ', '.join(BenchmarkRunner.cases))
+    print('  -s  save the results as the baseline instead of checking against it, needed once before checking')
+    print('  -t  fraction slower or bigger than the baseline that counts as a regression')
+    print('  -r  timed repeats of each case, at least ' + str(BenchmarkRunner.min_repeats))
+    print('Example: ./' + script_name + ' -s && <make a change> && ./' + script_name)
+    sys.exit(2)
+
+# Parse command line arguments and set default values for some
+opts = []
+args = []
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'f:n:c:b:st:r:d:h', ['file=', 'frames=', 'cases=', 'baseline=', 'save',
+                                                                 'threshold=', 'repeats=', 'debug=', 'help'])
+except getopt.GetoptError:
+    usage()
+
+for opt, arg in opts:
+    if opt in ('-h', '--help'):
+        usage()
+    elif opt in ('-f', '--file'):
+        captureFile = arg
+    elif opt in ('-n', '--frames'):
+        frames = int(arg)
+    elif opt in ('-c', '--cases'):
+        cases = arg.split(',')
+        if [case for case in cases if case not in BenchmarkRunner.cases]:
+            usage()
+    elif opt in ('-b', '--baseline'):
+        baselineFile = arg
+    elif opt in ('-s', '--save'):
+        save = True
+    elif opt in ('-t', '--threshold'):
+        threshold = float(arg)
+    elif opt in ('-r', '--repeats'):
+        repeats = int(arg)
+        if repeats < BenchmarkRunner.min_repeats:
+            usage()
+    elif opt in ('-d', '--debug'):
+        loggingLevel = arg
+    else:
+        usage()
+
+# Set up our logger
+log = log_setup('bench', loggingLevel)
+
+
+def main():
+
+    # Baselines are kept per corpus, results from different corpora can't be compared
+    if captureFile != '':
+        corpus = 'capture ' + os.path.basename(captureFile)
+        chunks = recorded_corpus(captureFile)
+    else:
+        corpus = 'synthetic ' + str(frames)
+        chunks = synthetic_corpus(frames)
+
+    runner = BenchmarkRunner(chunks, repeats=repeats)
+    results = runner.run(cases)
+    for case, result in results.items():
+        log.info(BenchmarkRunner.summary(case, result))
+
+    baseline = load_baseline(baselineFile)
+    passed = True
+
+    if save:
+        saved = baseline.get(corpus, {}).get('results', {})
+        saved.update(results)
+        baseline[corpus] = {'python': sys.version.split()[0],
+                            'saved': time.strftime('%Y-%m-%d %H:%M:%S'),
+                            'results': saved}
+        save_baseline(baselineFile, baseline)
+        log.info('Saved baseline for ' + corpus + ' to ' + baselineFile)
+    elif corpus not in baseline:
+        log.error('No baseline for ' + corpus + ' in ' + baselineFile + ', run with -s first to save one')
+        passed = False
+    else:
+        saved = baseline[corpus]
+        if saved['python'] != sys.version.split()[0]:
+            log.warning('Baseline was saved with Python ' + saved['python'])
+        regressions = BenchmarkRunner.compare(results, saved['results'], threshold)
+        for line in regressions:
+            log.error('Regression: ' + line)
+        passed = not regressions
+        log.info('PASSED' if passed else 'FAILED, more than {0:.0%} worse than the baseline from {1}'.format(
+            threshold, saved['saved']))
+
+    shutdown_logging()
+
+    sys.exit(0 if passed else 1)
+
+# Execute as standalone program
+if __name__ == '__main__':
+    try:
+        main()
+    except SystemExit:
+        raise
+    except:
+        log.exception('Exception')
+        raise
@@ -0,0 +1,409 @@
+#!/usr/bin/python
+
+"""
+Benchmarks of the protocol and pipeline hot paths, run against a corpus of bus traffic.
+
+The corpus is either synthetic, from the master simulator with its mix of screen traffic, DLE stuffing, other
+devices, noise and bad checksums, or recorded, from a capture file made with poolbot.py -r. Each case is run
+repeatedly for a minimum time and the best of at least min_repeats repeats is kept, reported as units per second and
+ns per unit. One more run under tracemalloc gives the peak memory allocated while it runs and anything left allocated
+after it, so a change that starts copying frames or leaking shows up even when it is not slower. Logging below
+warning is turned off while the cases run, so it is the code that is measured rather than the debug log.
+
+Results are compared against a saved baseline, and anything slower or hungrier than the baseline by more than a
+threshold is a regression. How far the median repeat is behind the best one is kept as the noise of each run, and a
+case has to be slower than the threshold plus the larger noise of the two runs, capped at the threshold again, so a
+busy machine does not flag regressions on its own and a real one is not hidden by it.
+"""
+
+from __future__ import (division, print_function)
+
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import apiserverClass
+from aqualinkClass import Aqualink
+from captureClass import CaptureReplay
+from frameDecoderClass import FrameDecoder, Frame
+from screenClass import Screen
+from simulatorClass import MasterSimulator
+
+
+class CorpusPort(object):
+    """Serial port look-alike that hands out a list of chunks, then raises EOFError like a finished replay"""
+
+    def __init__(self, chunks):
+        self.chunks = [bytes(chunk) for chunk in chunks if len(chunk)]
+        self.timeout = None
+        self.written = 0
+        self.rewind()
+
+    def rewind(self):
+        self.index = 0
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        if self.index == len(self.chunks):
+            return 0
+        return len(self.chunks[self.index]) - self.pos
+
+    def read(self, size=1):
+        if self.index == len(self.chunks):
+            raise EOFError('End of corpus')
+
+        chunk = self.chunks[self.index]
+        data = chunk[self.pos:self.pos + size]
+        self.pos += len(data)
+        if self.pos == len(chunk):
+            self.index += 1
+            self.pos = 0
+
+        return data
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class LocalSQS(object):
+    """In process stand-in for the SQS client calls ApiServer makes, each queue is a deque"""
+
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.receipts = itertools.count()
+
+    def get_queue_url(self, QueueName):
+        return {'QueueUrl': 'local://' + QueueName}
+
+    def create_queue(self, QueueName, Attributes=None):
+        return {'QueueUrl': 'local://' + QueueName}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        queue = self.queues[QueueUrl]
+        sent = str(int(time.time() * 1000))
+        for entry in Entries:
+            queue.append({'Body': entry['MessageBody'],
+                          'ReceiptHandle': str(next(self.receipts)),
+                          'Attributes': {'SentTimestamp': sent},
+                          'MessageAttributes': entry.get('MessageAttributes', {})})
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        queue = self.queues[QueueUrl]
+        messages = [queue.popleft() for i in range(min(MaxNumberOfMessages, len(queue)))]
+        return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def purge_queue(self, QueueUrl):
+        self.queues[QueueUrl].clear()
+
+
+def synthetic_corpus(frames, seed=1):
+    """Bus chunks for frames PDA frames from the simulator's usual mix, with some noise and bad checksums"""
+
+    simulator = MasterSimulator(noise=0.02, bad=0.02, others=0.2, seed=seed)
+    try:
+        return simulator.traffic(frames)
+    finally:
+        simulator.close()
+
+
+def recorded_corpus(filename):
+    """Bus chunks from a capture file, as they were read off the port"""
+
+    replay = CaptureReplay(filename)
+    try:
+        return [bytes(chunk) for when, chunk in replay.chunks()]
+    finally:
+        replay.close()
+
+
+class BenchmarkRunner(object):
+    """Runs the benchmark cases over one corpus"""
+
+    # Case: unit its results are per
+    cases = collections.OrderedDict((('readmsg', 'frame'),
+                                     ('checksum', 'frame'),
+                                     ('sendmsg', 'frame'),
+                                     ('dispatch', 'frame'),
+                                     ('screen', 'update'),
+                                     ('sqs', 'message')))
+
+    # Distinct DLE heavy payloads for sendmsg, more than the encoder caches so every one is encoded
+    payloads = 256
+
+    # State messages sent and received per sqs run
+    messages = 200
+
+    # Memory growth allowed on top of the threshold, so tiny numbers do not flag noise
+    memory_slack = 4096
+
+    # Fewer repeats than this and the best one is too much down to luck to compare
+    min_repeats = 5
+
+    def __init__(self, chunks, min_time=0.2, repeats=5):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        if repeats < BenchmarkRunner.min_repeats:
+            raise ValueError('at least {0} repeats are needed'.format(BenchmarkRunner.min_repeats))
+
+        self.min_time = min_time
+        self.repeats = repeats
+
+        self.port = CorpusPort(chunks)
+        self.aqualink = Aqualink('benchmark', port=self.port)
+
+        # Every valid frame in the corpus, with its own copy of the arguments
+        decoder = FrameDecoder(self.port)
+        self.frames = []
+        try:
+            for body in decoder:
+                self.frames.append(Frame(body[0], body[1], body[2:].tobytes()))
+        except EOFError:
+            pass
+        self.pda_frames = [frame for frame in self.frames if frame.dest == Aqualink.pdaAddr]
+
+        self.log.info('Corpus of {0} bytes in {1} chunks, {2} frames, {3} to the PDA'.format(
+            sum(len(chunk) for chunk in self.port.chunks), len(self.port.chunks), len(self.frames),
+            len(self.pda_frames)))
+
+    def _readmsg(self):
+        aqualink = self.aqualink
+        port = self.port
+
+        def run():
+            port.rewind()
+            aqualink.decoder.reset()
+            aqualink.frames = iter(aqualink.decoder)
+            count = 0
+            try:
+                while True:
+                    aqualink.readMsg()
+                    count += 1
+            except EOFError:
+                return count
+
+        return run
+
+    def _checksum(self):
+        checksum = self.aqualink.checksum
+        bodies = [bytes((frame.dest, frame.cmd)) + frame.args for frame in self.frames]
+
+        def run():
+            for body in bodies:
+                checksum(body)
+            return len(bodies)
+
+        return run
+
+    def _sendmsg(self):
+        sendMsg = self.aqualink.sendMsg
+        rand = random.Random(1)
+        msgs = []
+        for i in range(BenchmarkRunner.payloads):
+            args = bytes(rand.choice((0x10, 0x10, rand.randrange(256))) for j in range(16))
+            msgs.append((Aqualink.masterAddr, 0x04, args))
+
+        def run():
+            for msg in msgs:
+                sendMsg(msg)
+            return len(msgs)
+
+        return run
+
+    def _dispatch(self):
+        processMessage = self.aqualink.processMessage
+        frames = self.pda_frames
+
+        def run():
+            for frame in frames:
+                processMessage(frame)
+            return len(frames)
+
+        return run
+
+    def _screen(self):
+        screen = Screen()
+        ops = []
+        for frame in self.pda_frames:
+            args = frame.args
+            if frame.cmd == 0x00:
+                ops.append((screen.flush, ()))
+            elif frame.cmd == 0x02:
+                ops.append((screen.set_status, (args,)))
+            elif frame.cmd == 0x04 and args:
+                text = args[1:]
+                if b'\x00' in text:
+                    text = text[:text.index(b'\x00')]
+                ops.append((screen.write_line, (Aqualink.lineCodes.get(args[0], args[0]), text)))
+            elif frame.cmd == 0x08 and args:
+                ops.append((screen.invert_line, (args[0],)))
+            elif frame.cmd == 0x09:
+                ops.append((screen.cls, ()))
+            elif frame.cmd == 0x0f and len(args) >= 3:
+                ops.append((screen.scroll, (args[0], args[1], args[2])))
+            elif frame.cmd == 0x10 and len(args) >= 3:
+                ops.append((screen.invert_chars, (args[0], args[1], args[2])))
+
+        def run():
+            for method, args in ops:
+                method(*args)
+            return len(ops)
+
+        return run
+
+    def _sqs(self):
+        # ApiServer talks to whatever client get_client() hands out, and keeps its queue URLs out of the real cache
+        apiserverClass._client = LocalSQS()
+        apiserverClass.ClientError = LookupError
+        apiserverClass.queue_cache_file = os.path.join(tempfile.mkdtemp(), 'sqs_queues.json')
+
+        # We send on the write queue, a second server plays the Lambda reading it
+        sender = apiserverClass.ApiServer('benchrq.fifo', 'benchwq.fifo')
+        receiver = apiserverClass.ApiServer('benchwq.fifo', 'benchrq.fifo')
+
+        messages = []
+        for i in range(BenchmarkRunner.messages):
+            messages.append({'air_temp': 20 + i % 5, 'pool_temp': 27, 'spa_temp': 38, 'pool_mode': True,
+                             'spa_mode': bool(i % 2), 'pool_heater': False, 'spa_heater': False,
+                             'filter_pump': True, 'controller': 'pool'})
+
+        def run():
+            for message in messages:
+                sender.queue_msg(message)
+            sent = sender.flush()
+            received = 0
+            while True:
+                bodies = receiver.recieve_msg(wait_time=0)
+                if not bodies:
+                    break
+                received += len(bodies)
+            if received != sent:
+                raise RuntimeError('Sent {0} messages but received {1}'.format(sent, received))
+            return sent
+
+        return run
+
+    def measure(self, case):
+        """Results of one case as a dict"""
+
+        run = getattr(self, '_' + case)()
+
+        # Warm up, and find how many runs fill min_time
+        started = time.perf_counter()
+        units = run()
+        if not units:
+            raise ValueError('Nothing in the corpus for ' + case)
+        elapsed = time.perf_counter() - started
+        loops = max(1, int(self.min_time / elapsed) if elapsed > 0 else 1000)
+
+        times = []
+        for i in range(self.repeats):
+            started = time.perf_counter()
+            for j in range(loops):
+                run()
+            times.append((time.perf_counter() - started) / loops)
+        best = min(times)
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            run()
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return {'unit': BenchmarkRunner.cases[case],
+                'units': units,
+                'per_second': units / best,
+                'ns_per_unit': best * 1e9 / units,
+                'noise': statistics.median(times) / best - 1,
+                'peak_bytes': peak - before,
+                'retained_bytes': max(after - before, 0)}
+
+    def run(self, cases=None):
+        """Results of each case, by case"""
+
+        results = collections.OrderedDict()
+
+        # Debug logging would otherwise be most of what is measured, and the logging thread adds noise
+        logging.disable(logging.INFO)
+        try:
+            for case in cases or BenchmarkRunner.cases:
+                results[case] = self.measure(case)
+        finally:
+            logging.disable(logging.NOTSET)
+
+        return results
+
+    @staticmethod
+    def summary(case, result):
+        return '{0:<10} {1:>12,.0f} {2}s/s {3:>10,.0f} ns/{2}  peak {4:>8,.1f} KiB  retained {5:>8,} B'.format(
+            case, result['per_second'], result['unit'], result['ns_per_unit'], result['peak_bytes'] / 1024,
+            result['retained_bytes'])
+
+    @staticmethod
+    def compare(results, baseline, threshold):
+        """Lines describing each result that regressed against the baseline by more than threshold (a fraction)"""
+
+        regressions = []
+        for case, result in results.items():
+            base = baseline.get(case)
+            if base is None:
+                continue
+
+            # Baselines saved before noise was recorded count as noiseless
+            noise = min(max(result['noise'], base.get('noise', 0.0)), threshold)
+            limit = base['ns_per_unit'] * (1 + threshold + noise)
+            if result['ns_per_unit'] > limit:
+                regressions.append('{0}: {1:,.0f} ns/{2}, baseline {3:,.0f} ({4:+.0%})'.format(
+                    case, result['ns_per_unit'], result['unit'], base['ns_per_unit'],
+                    result['ns_per_unit'] / base['ns_per_unit'] - 1))
+
+            for key in ('peak_bytes', 'retained_bytes'):
+                limit = base[key] * (1 + threshold) + BenchmarkRunner.memory_slack
+                if result[key] > limit:
+                    regressions.append('{0}: {1} {2:,} B, baseline {3:,} B'.format(
+                        case, key.replace('_', ' '), result[key], base[key]))
+
+        return regressions
+
+
+def load_baseline(filename):
+    """Saved results by corpus name, empty if there are none"""
+
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_baseline(filename, baseline):
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(baseline, fh, indent=2, sort_keys=True)
+    os.rename(tmp, filename)
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+"""
+Record and replay raw RS485 bus traffic.
+
+A capture file is a small header followed by one record per chunk read off the port:
+
+    header:  'PBCAP' <version:u8> <start time:f64>
+    record:  <microseconds since previous record:u32> <length:u16> <raw bytes>
+
+All values are little endian. Writing is done on a background thread, so recording costs the bus loop no more than
+a queue put per chunk and no text formatting at all. Replay memory maps the file so overnight captures are never loaded into RAM, and
+looks enough like a serial port that it can be handed straight to the frame decoder.
+"""
+
+from __future__ import (division, print_function)
+
+import logging
+import mmap
+import queue
+import struct
+import threading
+import time
+
+
+header_fmt = struct.Struct('<5sBd')
+record_fmt = struct.Struct('<IH')
+
+magic = b'PBCAP'
+version = 1
+
+# Largest values that fit in a record header
+max_delta = 0xffffffff
+max_length = 0xffff
+
+
+class CaptureWriter(object):
+    """Appends timestamped chunks of raw bus data to a capture file"""
+
+    def __init__(self, filename):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.log.info('Recording bus traffic to ' + filename)
+
+        self.filename = filename
+        self.fh = open(filename, 'wb')
+
+        self.last = time.time()
+        self.fh.write(header_fmt.pack(magic, version, self.last))
+
+        self.bytes = 0
+
+        # Chunks waiting for the writer thread, None tells it to finish
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name='capture')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data, now=None):
+        """Record a chunk of data received at time now"""
+
+        if now is None:
+            now = time.time()
+        self.queue.put((now, bytes(data)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._write(*item)
+        self.fh.close()
+
+    def _write(self, now, data):
+        delta = int((now - self.last) * 1000000)
+        self.last = now
+
+        # Long silences get empty records to carry the time across
+        while delta > max_delta:
+            self.fh.write(record_fmt.pack(max_delta, 0))
+            delta -= max_delta
+        delta = max(delta, 0)
+
+        view = memoryview(data)
+        while len(view) > max_length:
+            self.fh.write(record_fmt.pack(delta, max_length))
+            self.fh.write(view[:max_length])
+            view = view[max_length:]
+            delta = 0
+
+        self.fh.write(record_fmt.pack(delta, len(view)))
+        self.fh.write(view)
+
+        self.bytes += len(data)
+
+    def close(self):
+        """Write out anything still queued and close the file"""
+
+        self.queue.put(None)
+        self.thread.join()
+        self.log.info('Recorded ' + str(self.bytes) + ' bytes to ' + self.filename)
+
+
+class CaptureReplay(object):
+    """Serial port look-alike that plays back a capture file.
+
+    With realtime set, reads are delayed so data comes out with the original timing (scaled by speed), otherwise
+    the file is played back as fast as it can be consumed. Reading past the end raises EOFError."""
+
+    def __init__(self, filename, realtime=False, speed=1.0):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.filename = filename
+        self.realtime = realtime
+        self.speed = speed
+
+        self.fh = open(filename, 'rb')
+        self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < header_fmt.size:
+            raise ValueError(filename + ' is not a capture file')
+
+        file_magic, file_version, self.start_time = header_fmt.unpack_from(self.map, 0)
+        if file_magic != magic or file_version != version:
+            raise ValueError(filename + ' is not a version ' + str(version) + ' capture file')
+
+        self.log.info('Replaying ' + filename + ' captured ' +
+                      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_time)))
+
+        self.size = len(self.map)
+        self.pos = header_fmt.size
+
+        # Unread part of the current record
+        self.chunk_pos = self.pos
+        self.chunk_end = self.pos
+
+        # Capture time of the current record, in seconds since the start of the capture
+        self.offset = 0.0
+        self.wall_start = None
+
+        self.written = 0
+
+    def _next_record(self):
+        """Move on to the next non-empty record, returns False at the end of the file"""
+
+        while self.pos + record_fmt.size <= self.size:
+            delta, length = record_fmt.unpack_from(self.map, self.pos)
+            self.offset += delta / 1000000
+            self.chunk_pos = self.pos + record_fmt.size
+            self.chunk_end = min(self.chunk_pos + length, self.size)
+            self.pos = self.chunk_end
+
+            if self.chunk_end > self.chunk_pos:
+                if self.realtime:
+                    self._wait()
+                return True
+
+        return False
+
+    def _wait(self):
+        """Sleep until this record is due"""
+
+        now = time.time()
+        if self.wall_start is None:
+            self.wall_start = now - self.offset / self.speed
+
+        due = self.wall_start + self.offset / self.speed
+        if due > now:
+            time.sleep(due - now)
+
+    @property
+    def in_waiting(self):
+        if self.chunk_pos == self.chunk_end and not self._next_record():
+            return 0
+        return self.chunk_end - self.chunk_pos
+
+    def read(self, size=1):
+        if self.chunk_pos == self.chunk_end and not self._next_record():
+            raise EOFError('End of capture ' + self.filename)
+
+        stop = min(self.chunk_pos + size, self.chunk_end)
+        data = self.map[self.chunk_pos:stop]
+        self.chunk_pos = stop
+
+        return data
+
+    def write(self, data):
+        # Nothing is listening, just keep count
+        self.written += len(data)
+        return len(data)
+
+    def chunks(self):
+        """Yield (timestamp, memoryview) for every record, ignoring realtime"""
+
+        view = memoryview(self.map)
+        pos = header_fmt.size
+        now = self.start_time
+
+        while pos + record_fmt.size <= self.size:
+            delta, length = record_fmt.unpack_from(self.map, pos)
+            now += delta / 1000000
+            pos += record_fmt.size
+            if length:
+                yield now, view[pos:pos + length]
+            pos += length
+
+    def close(self):
+        self.map.close()
+        self.fh.close()
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
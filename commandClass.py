@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+"""
+Runs commands received from the API read queue against the controllers.
+
+A command is a JSON object such as
+
+    {"id": "amzn1.request.123", "action": "set", "target": "spa_mode", "value": true, "controller": "pool"}
+    {"id": "amzn1.request.124", "action": "get", "target": "pool_temp"}
+    {"id": "amzn1.request.125", "action": "status"}
+    {"id": "amzn1.request.126", "action": "history", "target": "pool_temp", "start": 1700035200, "end": 1700049600}
+
+History commands are answered from the controller's local time series store, with an optional "resolution" of raw,
+1m, 1h or 1d picked to suit the range if it is left out.
+
+Commands wait in a priority queue so anything that changes equipment runs before status queries, and a few workers
+take them off it, one command at a time per controller so they run in that order. The controller's menus are guarded
+by its Aqualink, so sample reads and local API reads never interleave keys with a command. A command id seen in the
+last dedup_ttl seconds is not run again, and a command identical to one already waiting or running shares its result,
+so a burst of retries or repeated requests runs once. Every command is answered with an ack message on the write
+queue.
+"""
+
+from __future__ import (division, print_function)
+
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+from interfaceClass import Interface
+
+
+class Command(object):
+    """One parsed request"""
+
+    # Lower runs first
+    priorities = {'set': 0, 'get': 1, 'status': 1, 'history': 1}
+
+    def __init__(self, msg_id, action, target, value, controller):
+        self.id = msg_id
+        self.action = action
+        self.target = target
+        self.value = value
+        self.controller = controller
+        self.priority = Command.priorities[action]
+        self.received = time.time()
+
+    @classmethod
+    def parse(cls, data, default_controller):
+        """Command from a decoded message body, raises ValueError if it is not one we can run.
+        Fields are checked for type as well, they end up as dict keys and in log messages."""
+
+        if not isinstance(data, dict):
+            raise ValueError('command must be an object')
+
+        msg_id = data.get('id')
+        if msg_id is not None and not isinstance(msg_id, str):
+            raise ValueError('id must be a string')
+
+        controller = data.get('controller', default_controller)
+        if not isinstance(controller, str):
+            raise ValueError('controller must be a string')
+
+        action = data.get('action')
+        if action not in Command.priorities:
+            raise ValueError('unknown action ' + repr(action))
+
+        # Status reads everything, so any target is ignored
+        target = data.get('target') if action != 'status' else None
+        if action != 'status' and not isinstance(target, str):
+            raise ValueError(action + ' needs a target')
+
+        value = data.get('value')
+        if action == 'set' and not isinstance(value, bool):
+            raise ValueError('set needs a true or false value')
+        if action != 'set' and value is not None:
+            raise ValueError(action + ' takes no value')
+
+        if action == 'history':
+            start, end, resolution = data.get('start'), data.get('end'), data.get('resolution')
+            if not Command._is_time(start):
+                raise ValueError('history needs a start time in seconds since the epoch')
+            if end is not None and not Command._is_time(end):
+                raise ValueError('history end must be a time in seconds since the epoch')
+            if resolution is not None and not isinstance(resolution, str):
+                raise ValueError('history resolution must be a string')
+            value = (start, end, resolution)
+
+        return cls(msg_id, action, target, value, controller)
+
+    @staticmethod
+    def _is_time(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    def key(self):
+        """What the command does, identical commands share one run"""
+
+        return self.controller, self.action, self.target, self.value
+
+
+class CommandPipeline(object):
+    """Priority queue of commands with duplicate suppression"""
+
+    # Seconds a command id is remembered
+    dedup_ttl = 300
+
+    # Commands run at once, across all controllers
+    workers = 4
+
+    def __init__(self, supervisor, reply, stores=None):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.supervisor = supervisor
+
+        # Time series store of each controller, by tag, for history commands
+        self.stores = stores or {}
+
+        # Coroutine function sending an ack message
+        self.reply = reply
+
+        self.queue = asyncio.PriorityQueue()
+        self.order = itertools.count()
+
+        # Command id: (expiry time, future), and command key: future while queued or running
+        self.recent = {}
+        self.inflight = {}
+
+        # Commands for one controller run one after another in priority order. This only keeps the order, the menus
+        # are guarded by the Aqualink's own lock, which reads from elsewhere also take
+        self.locks = dict((tag, asyncio.Lock()) for tag in supervisor.tags())
+
+        self.counts = {'received': 0, 'invalid': 0, 'duplicate': 0, 'collapsed': 0, 'ok': 0, 'failed': 0}
+
+    def submit(self, body, reply=None):
+        """Queue a message body from the read queue, called from the receive loop.
+        The ack goes to reply if given, a coroutine function taking the message, instead of the write queue."""
+
+        if reply is None:
+            reply = self.reply
+
+        self.counts['received'] += 1
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        msg_id = data.get('id') if isinstance(data, dict) else None
+
+        try:
+            cmd = Command.parse(data, self.supervisor.tags()[0])
+            if cmd.controller not in self.locks:
+                raise ValueError('unknown controller ' + repr(cmd.controller))
+        except ValueError as e:
+            self.counts['invalid'] += 1
+            self.log.warning('Ignoring command ' + str(body) + ': ' + str(e))
+            asyncio.ensure_future(reply({'type': 'ack', 'id': msg_id, 'status': 'error', 'error': str(e)}))
+            return
+
+        self._expire()
+
+        if cmd.id is not None and cmd.id in self.recent:
+            # A retry of something we already have, answer it with the same result
+            self.counts['duplicate'] += 1
+            self.log.info('Command ' + str(cmd.id) + ' already seen')
+            asyncio.ensure_future(self._ack(cmd.id, self.recent[cmd.id][1], reply))
+            return
+
+        future = self.inflight.get(cmd.key())
+        if future is not None:
+            self.counts['collapsed'] += 1
+            self.log.info('Command ' + str(cmd.id) + ' shares the run of an identical one')
+        else:
+            future = asyncio.get_event_loop().create_future()
+            self.inflight[cmd.key()] = future
+            self.queue.put_nowait((cmd.priority, next(self.order), cmd, future))
+
+        if cmd.id is not None:
+            self.recent[cmd.id] = (time.time() + CommandPipeline.dedup_ttl, future)
+        asyncio.ensure_future(self._ack(cmd.id, future, reply))
+
+    def _expire(self):
+        now = time.time()
+        for msg_id in [msg_id for msg_id, (expires, future) in self.recent.items() if expires < now]:
+            del self.recent[msg_id]
+
+    async def _ack(self, msg_id, future, reply):
+        """Send the outcome of a command once it is known"""
+
+        message = {'type': 'ack', 'id': msg_id}
+        try:
+            message['result'] = await asyncio.shield(future)
+            message['status'] = 'ok'
+        except Exception as e:
+            message['status'] = 'error'
+            message['error'] = str(e)
+
+        await reply(message)
+
+    async def run(self):
+        """Take commands off the queue until cancelled"""
+
+        workers = [asyncio.ensure_future(self._worker()) for i in range(CommandPipeline.workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self):
+        while True:
+            priority, order, cmd, future = await self.queue.get()
+            try:
+                async with self.locks[cmd.controller]:
+                    result = await self._execute(cmd)
+                future.set_result(result)
+                self.counts['ok'] += 1
+                self.log.info('Ran {0} {1} on {2} in {3:.3f}s'.format(
+                    cmd.action, cmd.target or '', cmd.controller, time.time() - cmd.received))
+            except Exception as e:
+                future.set_exception(e)
+                self.counts['failed'] += 1
+                self.log.error('Command {0} {1} on {2} failed: {3!r}'.format(
+                    cmd.action, cmd.target or '', cmd.controller, e))
+            finally:
+                del self.inflight[cmd.key()]
+
+    def history(self, cmd):
+        """Answer a history command from the controller's time series store, raises ValueError if there isn't one"""
+
+        store = self.stores.get(cmd.controller)
+        if store is None:
+            raise ValueError('no history kept for ' + cmd.controller)
+        start, end, resolution = cmd.value
+        return store.history(cmd.target, start, end, resolution)
+
+    async def _execute(self, cmd):
+        if cmd.action == 'history':
+            return self.history(cmd)
+        # The Interface methods run on the controller's own loop
+        if cmd.action == 'set':
+            return await self.supervisor.call(cmd.controller, Interface.set, cmd.target, cmd.value)
+        if cmd.action == 'get':
+            return await self.supervisor.call(cmd.controller, Interface.get, cmd.target)
+        return await self.supervisor.call(cmd.controller, Interface.read_all)
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+"""
+Streaming decoder for Aqualink RS485 frames.
+
+A frame on the bus looks like DLE STX <dest> <cmd> <args...> <checksum> DLE ETX, with every DLE inside the frame
+followed by a stuffed NUL. Bytes are pulled from the port in bulk into a fixed reusable buffer and complete frames are
+handed out as memoryview slices of that buffer, so the hot path does not allocate per byte or per frame.
+"""
+
+from __future__ import (division, print_function)
+
+import collections
+import logging
+import time
+
+
+class Frame(collections.namedtuple('Frame', 'dest cmd args')):
+    """A decoded frame with integer dest and cmd.
+
+    args is normally a memoryview into the decoder buffer and, like the frame body, is only valid until the next
+    frame is requested. Take a copy with bytes(args) to keep it."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_body(cls, body):
+        return cls(body[0], body[1], body[2:])
+
+
+class FrameDecoder(object):
+    """Incremental DLE/STX ... DLE/ETX frame decoder"""
+
+    # Control bytes
+    NUL = 0x00
+    DLE = 0x10
+    STX = 0x02
+    ETX = 0x03
+
+    DLE_STX = b'\x10\x02'
+    DLE_ETX = b'\x10\x03'
+    DLE_NUL = b'\x10\x00'
+
+    # Longest frame we will wait for before deciding we lost the ETX and resyncing
+    max_frame = 128
+
+    # Size of the receive buffer, must be comfortably bigger than max_frame
+    buffer_size = 4096
+
+    def __init__(self, port=None):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.port = port
+
+        # Optional callable that is handed every chunk read from the port, used for recording captures
+        self.tap = None
+
+        # Receive buffer, data lives between start and end
+        self.buf = bytearray(FrameDecoder.buffer_size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+        # perf_counter() time of the last read from the port
+        self.received = 0.0
+
+        # Counters
+        self.frame_count = 0
+        self.byte_count = 0
+        self.bad_checksums = 0
+        self.resyncs = 0
+
+        # Optional 256 byte table of the destinations wanted, frames for anything else are skipped unchecked
+        self.accept = None
+        self.rejected = 0
+
+        self.started = time.time()
+        self._window_start = self.started
+        self._window_frames = 0
+
+    def fill(self):
+        """Read whatever the port has waiting into the buffer, blocking for at least one byte"""
+
+        want = self.port.in_waiting or 1
+        data = self.port.read(min(want, self._make_room()))
+        self.received = time.perf_counter()
+        if self.tap is not None:
+            self.tap(data)
+        self.feed(data)
+
+        return len(data)
+
+    def feed(self, data):
+        """Append raw bus bytes to the buffer"""
+
+        n = len(data)
+        if n > self._make_room():
+            # Can't happen with sane callers, so drop what we have and start clean
+            self.log.warning('Receive buffer overflow, discarding ' + str(self.end - self.start) + ' bytes')
+            self.resyncs += 1
+            self.start = self.end = 0
+            data = data[-FrameDecoder.buffer_size:]
+            n = len(data)
+
+        self.view[self.end:self.end + n] = data
+        self.end += n
+        self.byte_count += n
+
+    def reset(self):
+        """Drop anything buffered, e.g. a partial frame from a port that has gone away"""
+
+        if self.end > self.start:
+            self.resyncs += 1
+        self.start = self.end = 0
+
+    def _make_room(self):
+        """Move unconsumed data to the front of the buffer, returns the free space after it"""
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start and FrameDecoder.buffer_size - self.end < FrameDecoder.max_frame:
+            n = self.end - self.start
+            self.view[0:n] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = n
+
+        return FrameDecoder.buffer_size - self.end
+
+    def _unstuff(self, start, end):
+        """Remove the NUL following each DLE in buf[start:end] in place, returns the new end"""
+
+        buf = self.buf
+        view = self.view
+
+        idx = buf.find(FrameDecoder.DLE_NUL, start, end)
+        if idx < 0:
+            return end
+
+        write = idx + 1
+        read = idx + 2
+        while True:
+            idx = buf.find(FrameDecoder.DLE_NUL, read, end)
+            if idx < 0:
+                n = end - read
+                view[write:write + n] = view[read:end]
+                return write + n
+            n = idx + 1 - read
+            view[write:write + n] = view[read:idx + 1]
+            write += n
+            read = idx + 2
+
+    def frames(self):
+        """Yield every complete, valid frame currently buffered.
+
+        Each frame is a memoryview of <dest> <cmd> <args...> and is only valid until the next frame is requested."""
+
+        buf = self.buf
+        view = self.view
+        pos = self.start
+
+        while True:
+            end = self.end
+
+            stx = buf.find(FrameDecoder.DLE_STX, pos, end)
+            if stx < 0:
+                # Hang on to a trailing DLE, its STX may be in the next read
+                keep = end - 1 if end > pos and buf[end - 1] == FrameDecoder.DLE else end
+                self._discard(pos, keep)
+                self.start = keep
+                return
+
+            self._discard(pos, stx)
+
+            etx = buf.find(FrameDecoder.DLE_ETX, stx + 2, end)
+            if etx < 0:
+                if end - stx > FrameDecoder.max_frame:
+                    # Never saw the end of this one, look for the next start
+                    self.log.debug('Frame too long, resyncing')
+                    self.resyncs += 1
+                    pos = stx + 2
+                    continue
+                self.start = stx
+                return
+
+            # A new start before the end means we lost part of a frame
+            restart = buf.find(FrameDecoder.DLE_STX, stx + 2, etx)
+            if restart >= 0:
+                self.log.debug('Truncated frame, resyncing')
+                self.resyncs += 1
+                pos = restart
+                continue
+
+            pos = etx + 2
+            self.start = pos
+
+            if self.accept is not None and not self.accept[buf[stx + 2]]:
+                self.rejected += 1
+                continue
+
+            stop = self._unstuff(stx + 2, etx)
+            if stop - stx < 5:
+                # Needs at least dest, cmd and checksum
+                self.resyncs += 1
+                continue
+
+            body = view[stx + 2:stop - 1]
+            if (FrameDecoder.DLE + FrameDecoder.STX + sum(body)) & 0xff != buf[stop - 1]:
+                self.bad_checksums += 1
+                self.log.debug('IN ' + body.hex() + ' *** bad checksum ***')
+                continue
+
+            self.frame_count += 1
+            self._window_frames += 1
+            yield body
+
+    def _discard(self, start, stop):
+        """Skip bytes that are not part of a frame, NULs between frames are expected"""
+
+        if stop > start and self.buf.count(b'\x00', start, stop) != stop - start:
+            self.resyncs += 1
+
+    def __iter__(self):
+        """Yield frames forever, reading from the port as needed"""
+
+        while True:
+            for frame in self.frames():
+                yield frame
+            self.fill()
+
+    def rate(self):
+        """Frames per second decoded in the current throughput() window, without starting a new one. Safe to call
+        from another thread, the numbers read may be a frame apart but nothing is changed."""
+
+        elapsed = time.time() - self._window_start
+        return self._window_frames / elapsed if elapsed > 0 else 0.0
+
+    def throughput(self):
+        """Frames per second decoded since the last call, starting a new window"""
+
+        now = time.time()
+        elapsed = now - self._window_start
+        rate = self._window_frames / elapsed if elapsed > 0 else 0.0
+
+        self._window_start = now
+        self._window_frames = 0
+
+        return rate
+
+    def stats(self):
+        """Decoder counters for reporting"""
+
+        elapsed = time.time() - self.started
+
+        return {'frames': self.frame_count,
+                'bytes': self.byte_count,
+                'bad_checksums': self.bad_checksums,
+                'resyncs': self.resyncs,
+                'rejected': self.rejected,
+                'fps': self.frame_count / elapsed if elapsed > 0 else 0.0}
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+"""
+Encoder for Aqualink RS485 frames.
+
+Builds DLE STX <dest> <cmd> <args...> <checksum> DLE ETX in a preallocated buffer, stuffing a NUL after every DLE
+inside the frame. Encoded frames are cached since the PDA sends the same few ACKs over and over.
+"""
+
+from __future__ import (division, print_function)
+
+import logging
+
+
+class FrameEncoder(object):
+    """Frame encoder with a cache of recently encoded frames"""
+
+    DLE = 0x10
+    STX = 0x02
+
+    DLE_STX = b'\x10\x02'
+    DLE_ETX = b'\x10\x03'
+    DLE_NUL = b'\x10\x00'
+
+    # Largest frame payload we will encode, worst case doubles in size when every byte is a DLE
+    max_payload = 128
+
+    # Number of distinct encoded frames to keep
+    cache_size = 64
+
+    def __init__(self):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.buf = bytearray(2 * FrameEncoder.max_payload + 6)
+        self.view = memoryview(self.buf)
+        self.view[0:2] = FrameEncoder.DLE_STX
+
+        # Scratch space for the unstuffed payload
+        self.payload = bytearray(FrameEncoder.max_payload + 1)
+        self.payload_view = memoryview(self.payload)
+
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def checksum(data):
+        """Checksum of DLE STX plus the given bytes"""
+
+        return (FrameEncoder.DLE + FrameEncoder.STX + sum(data)) & 0xff
+
+    def encode(self, dest, cmd, args=b''):
+        """Return the stuffed frame for dest/cmd (ints) and args (bytes)"""
+
+        key = (dest, cmd, args)
+        frame = self.cache.get(key)
+        if frame is not None:
+            self.hits += 1
+            return frame
+
+        self.misses += 1
+
+        n = len(args) + 2
+        if n > FrameEncoder.max_payload:
+            raise ValueError('Frame payload too long: ' + str(n) + ' bytes')
+
+        payload = self.payload
+        view = self.view
+
+        # Lay out dest/cmd/args/checksum, then copy it across stuffing as we go
+        payload[0] = dest
+        payload[1] = cmd
+        self.payload_view[2:n] = args
+        payload[n] = (FrameEncoder.DLE + FrameEncoder.STX + dest + cmd + sum(args)) & 0xff
+        n += 1
+
+        out = 2
+        read = 0
+        while True:
+            idx = payload.find(FrameEncoder.DLE, read, n)
+            if idx < 0:
+                size = n - read
+                view[out:out + size] = self.payload_view[read:n]
+                out += size
+                break
+            size = idx + 1 - read
+            view[out:out + size] = self.payload_view[read:idx + 1]
+            out += size
+            self.buf[out] = 0x00
+            out += 1
+            read = idx + 1
+
+        view[out:out + 2] = FrameEncoder.DLE_ETX
+        frame = bytes(view[:out + 2])
+
+        if len(self.cache) >= FrameEncoder.cache_size:
+            self.cache.clear()
+        self.cache[key] = frame
+
+        return frame
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -9,7 +9,9 @@ changing the methods to work with the new controller.
 
 from __future__ import (division, print_function)
 
+import asyncio
 import logging
+import time
 
 from aqualinkClass import Aqualink
 
@@ -18,18 +20,110 @@ class Interface(object):
 
     supported_interfaces = ['aqualink']
 
-    def __init__(self, iface_type, serial_port):
+    # Seconds a reading is served from the cache before the controller is asked again
+    cache_ttl = 60
+
+    def __init__(self, iface_type, serial_port, cache_ttl=None):
 
         self.log = logging.getLogger(self.__class__.__name__)
 
+        self.cache_ttl = Interface.cache_ttl if cache_ttl is None else cache_ttl
+
+        # sensor name: (value, time read)
+        self.cache = {}
+        self._reading = None
+
+        # When the last full snapshot was started, values read since then are in it and single values can be newer
+        self.read_at = 0.0
+
         if iface_type == 'aqualink':
             self.iface = Aqualink(serial_port)
         else:
-            self.log.critical(iface_type + ' not a valid interface')
+            raise ValueError(iface_type + ' not a valid interface')
+
+
+    async def read_all(self, max_age=None):
+        """Snapshot of every sensor and equipment state, from the cache if it is all younger than max_age"""
+
+        ttl = self.cache_ttl if max_age is None else max_age
+
+        now = time.time()
+        if now - self.read_at <= ttl:
+            return dict((name, value) for name, (value, read) in self.cache.items() if read >= self.read_at)
+
+        # Callers that turn up while a read is in progress share it rather than walking the menus again
+        if self._reading is None:
+            self._reading = asyncio.ensure_future(self._read_all())
+        reading = self._reading
+
+        return dict(await asyncio.shield(reading))
+
+    async def _read_all(self):
+        try:
+            started = time.time()
+            values = await self.iface.readAll()
+
+            # Values from pages this pass did not visit keep the time they were really read, and are left out
+            updated = self.iface.state.updated
+            snapshot = {}
+            for name, value in values.items():
+                read = updated.get(name, 0.0)
+                self.cache[name] = (value, read)
+                if read >= started:
+                    snapshot[name] = value
+            self.read_at = started
+            return snapshot
+        finally:
+            self._reading = None
+
+    async def get(self, name, max_age=None):
+        """Single reading, served from the cache while it is fresh"""
+
+        ttl = self.cache_ttl if max_age is None else max_age
+
+        entry = self.cache.get(name)
+        if entry is not None and time.time() - entry[1] <= ttl:
+            return entry[0]
+
+        snapshot = await self.read_all(0)
+        if name in snapshot:
+            return snapshot[name]
+
+        # Not on the pages a read visits, the last value seen is all there is
+        entry = self.cache.get(name)
+        return entry[0] if entry is not None else None
+
+    async def set(self, name, value):
+        """Turn a piece of equipment on or off, returns its state afterwards"""
+
+        result = await self.iface.setEquipment(name, value)
+        if result is None:
+            self.cache.pop(name, None)
+            raise ValueError('Unable to set ' + name)
+        self.cache[name] = (result, time.time())
+        return result
+
+    async def get_temp(self, sensor):
+        return await self.get(sensor + '_temp')
+
+    def subscribe(self, callback):
+        """callback(changes) is called with a {name: value} dict whenever the controller state changes"""
+        self.iface.state.subscribe(callback)
+
+    def register_metrics(self, registry, **labels):
+        self.iface.registerMetrics(registry, **labels)
+
+    def attach(self, loop):
+        self.iface.attach(loop)
+
+    def detach(self, loop):
+        self.iface.detach(loop)
 
+    def start_capture(self, filename):
+        self.iface.startCapture(filename)
 
-    def get_temp(self, sensor):
-        return self.iface.get_temp(sensor)
+    def stop_capture(self):
+        self.iface.stopCapture()
 
 
 
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+"""
+Queue of keypresses waiting to be sent to the controller.
+
+The PDA can only press a key by putting it in its reply to a controller probe, so one key goes out per probe. Whole
+key sequences are queued up front and the next key is handed out on every probe, leaving no idle probes in the middle
+of a command.
+"""
+
+from __future__ import (division, print_function)
+
+import asyncio
+import collections
+import logging
+import time
+
+
+class KeySequence(object):
+    """Keys submitted together, the future completes when the last one has been sent"""
+
+    def __init__(self, codes, future, probes):
+        self.codes = codes
+        self.remaining = len(codes)
+        self.future = future
+        self.probes = probes
+        self.started = time.time()
+
+
+class KeyScheduler(object):
+    """Hands out queued key codes one per probe"""
+
+    def __init__(self, mark=None):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        # (key code, KeySequence or None)
+        self.queue = collections.deque()
+
+        # Optional callable, its value when a sequence completes is returned with the result
+        self.mark = mark
+
+        self.probes = 0
+        self.keys_sent = 0
+
+    def submit(self, codes):
+        """Queue a list of key codes, returns a future of (probe cycles taken, mark) once they are all sent"""
+
+        future = asyncio.get_event_loop().create_future()
+        if not codes:
+            future.set_result((0, self.mark() if self.mark else None))
+            return future
+
+        seq = KeySequence(codes, future, self.probes)
+        for code in codes:
+            self.queue.append((code, seq))
+
+        return future
+
+    def push(self, code):
+        """Queue a single key nobody is waiting on"""
+
+        self.queue.append((code, None))
+
+    def next_key(self):
+        """Called on every probe, returns the key code to send, 0 when there is nothing to press"""
+
+        self.probes += 1
+
+        while self.queue:
+            code, seq = self.queue.popleft()
+            if seq is None:
+                self.keys_sent += 1
+                return code
+            if seq.future.done():
+                # Given up on, skip the rest of it
+                continue
+
+            self.keys_sent += 1
+            seq.remaining -= 1
+            if seq.remaining == 0:
+                cycles = self.probes - seq.probes
+                self.log.debug('Sent {0} keys in {1} probes, {2:.3f}s'.format(
+                    len(seq.codes), cycles, time.time() - seq.started))
+                seq.future.set_result((cycles, self.mark() if self.mark else None))
+            return code
+
+        return 0
+
+    def depth(self):
+        """Keys waiting to be sent"""
+
+        return len(self.queue)
+
+    def clear(self):
+        """Drop everything queued"""
+
+        for code, seq in self.queue:
+            if seq is not None and not seq.future.done():
+                seq.future.cancel()
+        self.queue.clear()
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+
+"""
+Local command API, so automations on the same machine or LAN don't have to go through the cloud queues.
+
+Clients connect to a Unix socket, or a TCP port if one is configured, and send one JSON object per line. Commands
+are the same as on the read queue and are answered with the same ack messages, one JSON object per line, matched up
+by id:
+
+    {"id": "1", "action": "set", "target": "spa_mode", "value": true}
+    {"id": "2", "action": "get", "target": "pool_temp", "controller": "pool"}
+    {"id": "3", "action": "status"}
+    {"id": "4", "action": "history", "target": "pool_temp", "start": 1700035200}
+    {"id": "5", "action": "subscribe"}
+
+Sets run through the command pipeline like any other command. Gets and status queries are answered straight from a
+copy of each controller's state kept on the main loop, and only go to the controller if we don't have the value yet.
+History is read straight from the controller's local time series store.
+A subscribed client is sent the current state and then every change as it happens:
+
+    {"type": "state", "controller": "pool", "changes": {"spa_temp": 38}}
+
+Each client is served by its own task, so a slow command or client never holds up the others. A subscriber that
+stops reading is disconnected once a buffer limit's worth of changes is waiting for it.
+"""
+
+from __future__ import (division, print_function)
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import stat
+import time
+
+from commandClass import Command
+
+
+class LocalApiServer(object):
+    """Serves commands and state over a local socket"""
+
+    # Longest request line taken from a client
+    max_line = 65536
+
+    # Bytes waiting to be written to a subscriber before we give up on it
+    max_buffer = 262144
+
+    def __init__(self, supervisor, commands, path, address=None):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.supervisor = supervisor
+        self.commands = commands
+
+        # Unix socket path, and optional (host, port) to listen on as well
+        self.path = path
+        self.address = address
+
+        # Latest value of everything we have seen from each controller, and the ones we have a full snapshot of
+        self.state = dict((tag, {}) for tag in supervisor.tags())
+        self.complete = set()
+        supervisor.subscribe(self._changed)
+
+        # Writers of the clients being sent changes
+        self.subscribers = set()
+
+        self.servers = []
+        self.clients = 0
+
+        # Connections made so far, numbering each one so its ids can be kept apart from everyone else's
+        self.connections = 0
+        self.counts = {'requests': 0, 'cached': 0, 'invalid': 0, 'dropped': 0}
+
+    def register_metrics(self, registry):
+        registry.gauge('poolbot_local_clients', 'Clients connected to the local API', lambda: self.clients)
+        registry.gauge('poolbot_local_subscribers', 'Local API clients streaming state changes',
+                       lambda: len(self.subscribers))
+        for name in ('requests', 'cached', 'invalid', 'dropped'):
+            registry.counter('poolbot_local_' + name + '_total', 'Local API ' + name + ' count',
+                             functools.partial(self.counts.get, name))
+
+    async def start(self):
+
+        if os.path.exists(self.path):
+            # Left over from a previous run that did not shut down cleanly
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                self.log.critical(self.path + ' exists and is not a socket')
+            os.remove(self.path)
+        elif not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        self.servers.append(await asyncio.start_unix_server(self._client, self.path, limit=LocalApiServer.max_line))
+        self.log.info('Local API listening on ' + self.path)
+
+        if self.address is not None:
+            host, port = self.address
+            self.servers.append(await asyncio.start_server(self._client, host, port, limit=LocalApiServer.max_line))
+            self.log.info('Local API listening on {0}:{1}'.format(host, port))
+
+    async def run(self):
+        """Serve until cancelled"""
+
+        await self.start()
+        try:
+            # Fill in the state from the controllers, sharing any read already going on
+            for tag, snapshot in (await self.supervisor.read_all()).items():
+                self.snapshot(tag, snapshot)
+
+            await asyncio.gather(*[server.serve_forever() for server in self.servers])
+        finally:
+            self.stop()
+
+    def stop(self):
+        for server in self.servers:
+            server.close()
+        self.servers = []
+        for writer in list(self.subscribers):
+            writer.close()
+        self.subscribers.clear()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def snapshot(self, tag, snapshot):
+        """Take a full snapshot of a controller's state"""
+
+        self.complete.add(tag)
+        self._changed(tag, snapshot)
+
+    def _changed(self, tag, changes):
+        state = self.state[tag]
+        changes = dict((name, value) for name, value in changes.items() if name not in state or state[name] != value)
+        if not changes:
+            return
+        state.update(changes)
+
+        if self.subscribers:
+            line = LocalApiServer._encode({'type': 'state', 'controller': tag, 'changes': changes})
+            for writer in list(self.subscribers):
+                self._stream(writer, line)
+
+    def _stream(self, writer, line):
+        if writer.transport.get_write_buffer_size() > LocalApiServer.max_buffer:
+            self.log.warning('Dropping a local subscriber that is not keeping up')
+            self.counts['dropped'] += 1
+            self.subscribers.discard(writer)
+            writer.close()
+            return
+        writer.write(line)
+
+    @staticmethod
+    def _encode(message):
+        return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+    async def _client(self, reader, writer):
+        """Serve one connection until the client goes away"""
+
+        self.clients += 1
+        self.connections += 1
+        conn = self.connections
+        self.log.debug('Local client {0} connected'.format(conn))
+
+        async def reply(message):
+            if not writer.is_closing():
+                writer.write(LocalApiServer._encode(message))
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    await reply({'type': 'ack', 'id': None, 'status': 'error', 'error': 'request too long'})
+                    break
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').strip()
+                if line:
+                    self._request(line, writer, reply, conn)
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # Shutting down, asyncio's stream callback logs an error for a connection task that ends cancelled
+            pass
+        finally:
+            self.clients -= 1
+            self.subscribers.discard(writer)
+            writer.close()
+            self.log.debug('Local client {0} disconnected'.format(conn))
+
+    def _request(self, body, writer, reply, conn):
+        """Answer one request line from connection conn, anything that has to wait is answered later through reply"""
+
+        self.counts['requests'] += 1
+        started = time.perf_counter()
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        msg_id = data.get('id') if isinstance(data, dict) else None
+
+        if isinstance(data, dict) and data.get('action') == 'subscribe':
+            self.subscribers.add(writer)
+            writer.write(LocalApiServer._encode({'type': 'ack', 'id': msg_id, 'status': 'ok'}))
+            for tag, state in sorted(self.state.items()):
+                if state:
+                    self._stream(writer, LocalApiServer._encode({'type': 'state', 'controller': tag,
+                                                                 'changes': dict(state)}))
+            return
+
+        try:
+            cmd = Command.parse(data, self.supervisor.tags()[0])
+        except ValueError:
+            # The pipeline rejects it with the usual error ack
+            self.counts['invalid'] += 1
+            self.commands.submit(body, reply)
+            return
+
+        if cmd.action == 'history':
+            try:
+                message = {'type': 'ack', 'id': cmd.id, 'status': 'ok', 'result': self.commands.history(cmd)}
+            except ValueError as e:
+                message = {'type': 'ack', 'id': cmd.id, 'status': 'error', 'error': str(e)}
+            writer.write(LocalApiServer._encode(message))
+            self.log.debug('Answered history {0} from the store in {1:.3f}ms'.format(
+                cmd.target, (time.perf_counter() - started) * 1000))
+            return
+
+        state = self.state.get(cmd.controller)
+        result = None
+        if state is None or cmd.action == 'set':
+            pass
+        elif cmd.action == 'status' and cmd.controller in self.complete:
+            result = dict(state)
+        elif cmd.action == 'get' and cmd.target in state:
+            result = state[cmd.target]
+
+        if result is None:
+            self.commands.submit(*LocalApiServer._namespace(data, conn, functools.partial(self._learn, cmd, reply)))
+            return
+
+        self.counts['cached'] += 1
+        writer.write(LocalApiServer._encode({'type': 'ack', 'id': cmd.id, 'status': 'ok', 'result': result}))
+        self.log.debug('Answered {0} {1} from the cache in {2:.3f}ms'.format(
+            cmd.action, cmd.target or '', (time.perf_counter() - started) * 1000))
+
+    @staticmethod
+    def _namespace(data, conn, reply):
+        """Body and reply to hand the pipeline, with the client's id made unique to its connection.
+        Local clients tend to number their requests from 1, and the pipeline answers an id it has seen in the last
+        few minutes with the earlier result, so a reused id would otherwise get another command's answer and not
+        run. The ack gets the client's own id back."""
+
+        msg_id = data.get('id')
+        if msg_id is None:
+            return json.dumps(data), reply
+
+        async def restore(message):
+            await reply(dict(message, id=msg_id))
+
+        return json.dumps(dict(data, id='local/{0}/{1}'.format(conn, msg_id))), restore
+
+    async def _learn(self, cmd, reply, message):
+        """Keep what a command that went to the controller found out, then pass its ack on"""
+
+        if message.get('status') == 'ok':
+            if cmd.action == 'status':
+                self.snapshot(cmd.controller, message['result'])
+            elif message['result'] is not None:
+                self._changed(cmd.controller, {cmd.target: message['result']})
+        await reply(message)
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
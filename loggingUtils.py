@@ -7,8 +7,11 @@
 from __future__ import (division, print_function)
 import os
 import sys
-import yaml
+import json
 import time
+import queue
+import string
+import threading
 import logging
 import logging.config
 import logging.handlers
@@ -20,9 +23,16 @@ base_dir = os.path.dirname(os.path.abspath(__file__))
 # Defile the location to find logs
 loggingPath = os.path.join(base_dir, 'logs')
 
+# Parsed copy of conf/logging.yaml, so we don't need to load PyYAML and parse it on every start
+logging_conf = os.path.join(base_dir, 'conf', 'logging.yaml')
+logging_cache = os.path.join(base_dir, 'cache', 'logging.json')
+
 # Define the available log levels
 valid_log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 
+# Background threads writing queued log records, stopped by shutdown_logging()
+listeners = []
+
 
 # Create a custom handler for files
 class MyFileHandler(logging.handlers.RotatingFileHandler):
@@ -34,16 +44,90 @@ class MyFileHandler(logging.handlers.RotatingFileHandler):
 
 
 # Create a custom handler so critical level logs call sys.exit(1)
+# This stays on the calling thread, so anything still queued is written out before we go
+# sys.exit only ends the thread it is called on, so from any other thread the whole process is ended
 class ShutdownHandler(logging.StreamHandler):
     def emit(self, record):
         self.format(record)
-        logging.shutdown()
-        sys.exit(1)
+        shutdown_logging()
+        if threading.current_thread() is threading.main_thread():
+            sys.exit(1)
+        os._exit(1)
+
+
+# Queue records as they are, formatting happens later on the listener thread
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        if record.exc_info:
+            # Tracebacks must be rendered while the exception is still current
+            return logging.handlers.QueueHandler.prepare(self, record)
+        return record
+
+
+# Log argument that hex encodes a frame only if the record is actually written out
+# Takes a copy as the decoder reuses its buffer
+class HexBytes(object):
+    __slots__ = ('data', 'text')
+
+    def __init__(self, data, text=False):
+        self.data = bytes(data)
+        self.text = text
+
+    def __str__(self):
+        if not self.text:
+            return self.data.hex()
+        printable = ''.join(c for c in self.data.decode('latin-1') if c in string.printable)
+        return self.data.hex() + ' (' + printable + ')'
+
+
+def queue_handlers(logger):
+    """Move a logger's handlers onto a background thread, only the shutdown handler runs inline"""
+
+    inline = [h for h in logger.handlers if isinstance(h, ShutdownHandler)]
+    queued = [h for h in logger.handlers if not isinstance(h, ShutdownHandler)]
+    if not queued:
+        return
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *queued, respect_handler_level=True)
+    listener.start()
+    listeners.append(listener)
+
+    logger.handlers = [DeferredQueueHandler(records)] + inline
+
+
+def load_logging_config():
+    """The logging config, from the cache if it was made from the current yaml file"""
+
+    stat = os.stat(logging_conf)
+    source = [stat.st_mtime, stat.st_size]
+
+    try:
+        with open(logging_cache) as fh:
+            cached = json.load(fh)
+        if cached['source'] == source:
+            return cached['config']
+    except (IOError, ValueError, KeyError):
+        pass
+
+    import yaml
+    with open(logging_conf) as fh:
+        config = yaml.safe_load(fh)
+
+    try:
+        if not os.path.exists(os.path.dirname(logging_cache)):
+            os.makedirs(os.path.dirname(logging_cache))
+        with open(logging_cache, 'w') as fh:
+            json.dump({'source': source, 'config': config}, fh)
+    except IOError as e:
+        print('WARNING: Unable to cache logging config: ' + str(e))
+
+    return config
 
 
 def log_setup(logger_name, logging_level):
 
-    logging_data = yaml.safe_load(open(os.path.join(base_dir, 'conf', 'logging.yaml')))
+    logging_data = load_logging_config()
 
     # Update the console handler from cmd line if required
     if logging_level != '':
@@ -59,6 +143,11 @@ def log_setup(logger_name, logging_level):
     # Load our logging config into the logger
     logging.config.dictConfig(logging_data)
 
+    # Keep file and console I/O off the threads servicing the serial bus
+    queue_handlers(logging.getLogger())
+    for name in logging_data.get('loggers', {}):
+        queue_handlers(logging.getLogger(name))
+
     # Create an instance of our logger
     log = logging.getLogger(logger_name)
 
@@ -71,8 +160,11 @@ def log_setup(logger_name, logging_level):
 
 
 def shutdown_logging():
+    while listeners:
+        listeners.pop().stop()
     logging.shutdown()
 
+
 # execute as standalone program
 if __name__ == '__main__':
     print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+
+# Small utils for collecting timing and throughput numbers, and exporting them
+# Not meant to be run as a standalone module
+
+from __future__ import (division, print_function)
+
+import bisect
+import collections
+import logging
+import os
+import time
+
+
+# Default histogram bucket upper bounds, in seconds, from 50us to 1s
+default_buckets = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class Histogram(object):
+    """Fixed bucket histogram, cheap enough to observe on every frame"""
+
+    def __init__(self, name, buckets=default_buckets):
+        self.name = name
+        self.buckets = tuple(buckets)
+
+        # One count per bucket plus the overflow bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the given percentile, the max for the overflow bucket"""
+
+        if not self.count:
+            return 0.0
+
+        target = self.count * pct / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def summary(self):
+        """One line summary in milliseconds"""
+
+        return '{0}: n={1} mean={2:.3f}ms p50<={3:.3f}ms p99<={4:.3f}ms max={5:.3f}ms'.format(
+            self.name, self.count, self.mean() * 1000, self.percentile(50) * 1000, self.percentile(99) * 1000,
+            self.max * 1000)
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class StartupTimer(object):
+    """Time taken by each stage of starting up, stages can be marked from any thread"""
+
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+
+        # (stage, perf_counter() time it finished)
+        self.marks = []
+
+    def mark(self, stage):
+        self.marks.append((stage, time.perf_counter()))
+
+    def stages(self):
+        """(stage, seconds it took, seconds since start) in the order they finished"""
+
+        last = self.start
+        stages = []
+        for stage, when in sorted(self.marks, key=lambda mark: mark[1]):
+            stages.append((stage, when - last, when - self.start))
+            last = when
+        return stages
+
+    def summary(self):
+        return 'Startup: ' + ', '.join('{0} {1:.3f}s'.format(stage, took) for stage, took, at in self.stages()) + \
+               ', total {0:.3f}s'.format(time.perf_counter() - self.start)
+
+    def register(self, registry):
+        for stage, when in self.marks:
+            registry.gauge('poolbot_startup_seconds', 'Seconds from start to the end of each startup stage',
+                           lambda when=when: when - self.start, stage=stage)
+
+
+class Registry(object):
+    """Named metrics in the Prometheus text format.
+
+    Counters and gauges are callables read only when the metrics are rendered, so the code being measured keeps
+    its plain attributes and pays nothing extra. Written out as a file for the node_exporter textfile collector."""
+
+    def __init__(self):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        # name: (type, help, [(labels, source)])
+        self.metrics = collections.OrderedDict()
+
+    def _add(self, kind, name, help, source, labels):
+        entry = self.metrics.setdefault(name, (kind, help, []))
+        if entry[0] != kind:
+            self.log.critical('Metric ' + name + ' registered as both ' + entry[0] + ' and ' + kind)
+        entry[2].append((labels, source))
+
+    def counter(self, name, help, source, **labels):
+        """Ever increasing count, source() returns the current value"""
+        self._add('counter', name, help, source, labels)
+
+    def gauge(self, name, help, source, **labels):
+        """Value that goes up and down, source() returns the current value"""
+        self._add('gauge', name, help, source, labels)
+
+    def histogram(self, name, help, histogram, **labels):
+        self._add('histogram', name, help, histogram, labels)
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        items = sorted(labels.items())
+        if extra is not None:
+            items.append(extra)
+        if not items:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(k, v) for k, v in items) + '}'
+
+    def render(self):
+        lines = []
+        for name, (kind, help, sources) in self.metrics.items():
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, source in sources:
+                if kind != 'histogram':
+                    lines.append('{0}{1} {2}'.format(name, Registry._labels(labels), source()))
+                    continue
+
+                # Buckets are cumulative in the exposition format
+                counts = list(source.counts)
+                seen = 0
+                for bound, count in zip(source.buckets + (float('inf'),), counts):
+                    seen += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{0}_bucket{1} {2}'.format(name, Registry._labels(labels, ('le', le)), seen))
+                lines.append('{0}_sum{1} {2}'.format(name, Registry._labels(labels), source.sum))
+                lines.append('{0}_count{1} {2}'.format(name, Registry._labels(labels), seen))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename):
+        """Write the metrics out, via a rename so the collector never sees a partial file"""
+
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(self.render())
+        os.rename(tmp, filename)
+
+
+# Registry everything in the process reports to
+registry = Registry()
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+
+"""
+Compact encoding of many timestamped samples in one message body.
+
+Self contained, using only the standard library, so the same file can be dropped into the Lambda function that reads
+the queue and decoded there with decode_body(). Plain JSON bodies start with '{' so both kinds can share a queue.
+
+A body is the base64 text of
+
+    'PB' <version:u8> <flags:u8>
+    <controller name> <field count:varint> then per field <kind:u8> <name>
+    <first timestamp, ms since the epoch:varint> <sample count:varint>
+
+followed by each sample as
+
+    <ms since the previous sample, zigzag:varint> <bitmap of the fields that changed> <value of each changed field>
+
+Names are a varint length and UTF-8 bytes. An integer or boolean value is the zigzag difference from the field's
+previous value plus one, a float value is a one followed by the float64 so no resolution is lost, and a zero means
+the field has no value from this sample on. With the compressed flag set everything after the flags is zlib data.
+"""
+
+from __future__ import (division, print_function)
+
+import base64
+import json
+import os
+import struct
+import zlib
+
+
+magic = b'PB'
+version = 1
+
+# Flag bits
+compressed = 0x01
+
+# Field kinds
+kind_int = 0
+kind_bool = 1
+kind_float = 2
+
+float_fmt = struct.Struct('<d')
+
+
+def put_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def get_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def put_name(buf, name):
+    data = name.encode('utf-8')
+    put_varint(buf, len(data))
+    buf.extend(data)
+
+
+def get_name(data, pos):
+    length, pos = get_varint(data, pos)
+    return bytes(data[pos:pos + length]).decode('utf-8'), pos + length
+
+
+def kind_of(value):
+    if isinstance(value, bool):
+        return kind_bool
+    if isinstance(value, int):
+        return kind_int
+    return kind_float
+
+
+class SamplePacker(object):
+    """Packs timestamped samples of a fixed set of fields into as few message bodies as possible"""
+
+    # Largest body we will produce, the SQS message size limit less room for the message attributes
+    max_body = 261120
+
+    def __init__(self, fields, controller=''):
+        self.fields = list(fields)
+        self.controller = controller
+        self.bitmap_size = (len(self.fields) + 7) // 8
+        self._reset()
+
+    def _reset(self):
+        self.samples = bytearray()
+        self.count = 0
+        self.first = None
+        self.last_time = None
+        self.last = [None] * len(self.fields)
+        self.kinds = [None] * len(self.fields)
+
+    def __len__(self):
+        return self.count
+
+    def age(self, now):
+        """Seconds from the first sample waiting to be sent to now"""
+
+        return now - self.first / 1000 if self.count else 0
+
+    def _header(self):
+        buf = bytearray()
+        put_name(buf, self.controller)
+        put_varint(buf, len(self.fields))
+        for name, kind in zip(self.fields, self.kinds):
+            buf.append(kind_int if kind is None else kind)
+            put_name(buf, name)
+        put_varint(buf, self.first)
+        put_varint(buf, self.count)
+        return buf
+
+    def _encode(self, snapshot, when):
+        """Encoded sample, None if a value does not fit the kind its field already has in this body"""
+
+        buf = bytearray()
+        put_varint(buf, zigzag(when - self.last_time) if self.last_time is not None else 0)
+
+        bitmap = bytearray(self.bitmap_size)
+        values = bytearray()
+        kinds = list(self.kinds)
+        for i, name in enumerate(self.fields):
+            value = snapshot.get(name)
+            if value is None:
+                if self.last[i] is not None:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+                    values.append(0)
+                continue
+
+            kind = kind_of(value)
+            if kinds[i] is None:
+                kinds[i] = kind
+            elif kinds[i] != kind:
+                if kinds[i] == kind_float:
+                    value = float(value)
+                elif kinds[i] == kind_int and kind == kind_float and value.is_integer():
+                    value = int(value)
+                else:
+                    return None
+            if value == self.last[i] and type(value) == type(self.last[i]):
+                continue
+
+            bitmap[i >> 3] |= 1 << (i & 7)
+            if kinds[i] == kind_float:
+                values.append(1)
+                values.extend(float_fmt.pack(value))
+            else:
+                previous = int(self.last[i]) if self.last[i] is not None else 0
+                put_varint(values, zigzag(int(value) - previous) + 1)
+
+        buf.extend(bitmap)
+        buf.extend(values)
+        self.kinds = kinds
+        return buf
+
+    def _commit(self, snapshot, when, sample):
+        if self.first is None:
+            self.first = when
+        self.samples.extend(sample)
+        self.count += 1
+        self.last_time = when
+        for i, name in enumerate(self.fields):
+            value = snapshot.get(name)
+            if value is not None and self.kinds[i] == kind_float:
+                value = float(value)
+            elif value is not None and self.kinds[i] == kind_int:
+                value = int(value)
+            self.last[i] = value
+
+    def add(self, snapshot, when):
+        """Add a sample taken at when (seconds since the epoch).
+        Returns a finished body when the sample did not fit in the one being built, otherwise None."""
+
+        when = int(round(when * 1000))
+        finished = None
+
+        kinds = list(self.kinds)
+        sample = self._encode(snapshot, when) if self.count else None
+        if sample is not None and self._size() + len(sample) > self._raw_limit():
+            sample = None
+        if sample is None and self.count:
+            self.kinds = kinds
+            finished = self.flush()
+        if sample is None:
+            sample = self._encode(snapshot, when)
+
+        self._commit(snapshot, when, sample)
+        return finished
+
+    def _size(self):
+        # Header estimate, the two varints in it can grow by a few bytes
+        return 8 + len(self.controller) + sum(len(name) + 2 for name in self.fields) + 10 + len(self.samples)
+
+    def _raw_limit(self):
+        # Before compression, so a body always fits even if compression does not help
+        return self.max_body * 3 // 4 - 8
+
+    def body(self):
+        """The body holding everything added so far, None if there is nothing. The samples stay in the packer"""
+
+        if not self.count:
+            return None
+
+        payload = bytes(self._header() + self.samples)
+        flags = 0
+        packed = zlib.compress(payload, 9)
+        if len(packed) < len(payload):
+            payload = packed
+            flags |= compressed
+
+        return base64.b64encode(magic + bytes((version, flags)) + payload).decode('ascii')
+
+    def flush(self):
+        """The body holding everything added so far, None if there is nothing, and start a new one"""
+
+        body = self.body()
+        self._reset()
+        return body
+
+    def save(self, filename):
+        """Write the samples not yet flushed to filename, or remove it if there are none, so they survive a restart"""
+
+        body = self.body()
+        if body is None:
+            if os.path.exists(filename):
+                os.remove(filename)
+            return
+
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(body)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, filename)
+
+    def load(self, filename):
+        """Add back the samples save() left in filename, returns how many"""
+
+        try:
+            with open(filename) as fh:
+                controller, samples = decode(fh.read())
+        except (IOError, OSError, ValueError, zlib.error):
+            return 0
+
+        for sample in samples:
+            when = sample.pop('time')
+            self.add(sample, when)
+        return len(samples)
+
+
+def decode(body):
+    """Decode a packed body into (controller, [sample dict with a 'time' key, ...])"""
+
+    data = base64.b64decode(body)
+    if data[:2] != magic:
+        raise ValueError('not a packed sample body')
+    if data[2] != version:
+        raise ValueError('unsupported packed sample version ' + str(data[2]))
+
+    flags = data[3]
+    data = data[4:]
+    if flags & compressed:
+        data = zlib.decompress(data)
+
+    controller, pos = get_name(data, 0)
+    nfields, pos = get_varint(data, pos)
+    fields = []
+    kinds = []
+    for i in range(nfields):
+        kinds.append(data[pos])
+        name, pos = get_name(data, pos + 1)
+        fields.append(name)
+
+    when, pos = get_varint(data, pos)
+    count, pos = get_varint(data, pos)
+    bitmap_size = (nfields + 7) // 8
+
+    samples = []
+    last = [None] * nfields
+    for n in range(count):
+        delta, pos = get_varint(data, pos)
+        when += unzigzag(delta)
+        bitmap = data[pos:pos + bitmap_size]
+        pos += bitmap_size
+
+        for i in range(nfields):
+            if not bitmap[i >> 3] & (1 << (i & 7)):
+                continue
+            code, pos = get_varint(data, pos)
+            if code == 0:
+                last[i] = None
+            elif kinds[i] == kind_float:
+                last[i] = float_fmt.unpack_from(data, pos)[0]
+                pos += float_fmt.size
+            else:
+                value = (last[i] or 0) + unzigzag(code - 1)
+                last[i] = bool(value) if kinds[i] == kind_bool else value
+
+        sample = {'time': when / 1000}
+        for name, value in zip(fields, last):
+            if value is not None:
+                sample[name] = value
+        samples.append(sample)
+
+    return controller, samples
+
+
+def decode_body(body):
+    """Decode any message body, JSON or packed, into a list of sample dicts"""
+
+    if body.lstrip().startswith('{'):
+        return [json.loads(body)]
+
+    controller, samples = decode(body)
+    if controller:
+        for sample in samples:
+            sample['controller'] = controller
+    return samples
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
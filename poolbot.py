@@ -12,13 +12,27 @@ from __future__ import (division, print_function)
 import sys
 import os
 import getopt
-import threading
+import signal
+import functools
+import asyncio
+import time
 
-from time import sleep
+# Everything from here on counts towards the startup time
+started = time.perf_counter()
 
+from metricsUtils import registry, StartupTimer
 from loggingUtils import log_setup, shutdown_logging
-from interfaceClass import Interface
+from supervisorClass import Supervisor
 from apiserverClass import ApiServer
+from timeseriesClass import TimeSeriesStore
+from publisherClass import ChangePublisher
+from commandClass import CommandPipeline
+from spoolClass import Spool
+from payloadUtils import SamplePacker
+from localApiClass import LocalApiServer
+
+startup = StartupTimer(started)
+startup.mark('imports')
 
 # Configuration
 
@@ -28,8 +42,10 @@ base_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Init our cmd line args
 controller = ''
-port = ''
+ports = []
 loggingLevel = ''
+captureFile = ''
+localAddress = None
 
 # Base name of the project
 baseName = 'poolbot'
@@ -37,11 +53,30 @@ baseName = 'poolbot'
 # Every 10 mins we want to wake up and get the current data from the system
 sleep_time = 600
 
+# Metrics for the node_exporter textfile collector, rewritten every metrics_interval seconds
+metrics_file = os.path.join(base_dir, 'metrics', baseName + '.prom')
+metrics_interval = 15
+
+# Values kept in the local time series store, the order fixes the record layout on disk
+telemetry_fields = ['air_temp', 'pool_temp', 'spa_temp', 'pool_mode', 'spa_mode', 'pool_heater', 'spa_heater',
+                    'filter_pump']
+
+# Local API socket, always served alongside the cloud queues
+local_socket = os.path.join(base_dir, 'run', baseName + '.sock')
+
+# Samples are sent packed together, a body every pack_interval seconds or sooner if it fills up. The ones not sent
+# yet are saved next to the spool after every sample, so a crash or restart does not lose them
+pack_interval = 3600
+pack_dir = os.path.join(base_dir, 'spool')
+
 
 # Usage method
 def usage():
-    print('Usage: ./' + script_name + ' -c <controller> -p <port> [-d debug level]')
+    print('Usage: ./' + script_name + ' -c <controller> -p [name=]<port> [-p ...] [-d debug level] [-r <capture file>] '
+          '[-l [host:]port]')
+    print('  -l  also serve the local API on a TCP port, localhost unless a host is given. It has no authentication')
     print('Example: ./' + script_name + ' -c aqualink -p /dev/ttyUSB0')
+    print('Example: ./' + script_name + ' -c aqualink -p pool=/dev/ttyUSB0 -p spa=/dev/ttyUSB1')
     sys.exit(2)
 
 # Parse command line arguments and set default values for some
@@ -49,7 +84,8 @@ opts = []
 args = []
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'c:p:d:h', ['controller=', 'port=', 'debug=', 'help'])
+    opts, args = getopt.getopt(sys.argv[1:], 'c:p:d:r:l:h', ['controller=', 'port=', 'debug=', 'record=', 'listen=',
+                                                             'help'])
 except getopt.GetoptError:
     usage()
 
@@ -59,9 +95,17 @@ for opt, arg in opts:
     elif opt in ('-c', '--controller'):
         controller = arg
     elif opt in ('-p', '--port'):
-        port = arg
+        ports.append(arg)
     elif opt in ('-d', '--debug'):
         loggingLevel = arg
+    elif opt in ('-r', '--record'):
+        captureFile = arg
+    elif opt in ('-l', '--listen'):
+        host, sep, port = arg.rpartition(':')
+        try:
+            localAddress = (host or 'localhost', int(port))
+        except ValueError:
+            usage()
     else:
         usage()
 
@@ -70,37 +114,168 @@ if controller == '':
     print('ERROR: Controller must be provided', file=sys.stderr)
     usage()
 
-if port == '':
+if not ports:
     print('ERROR: Port must be provided', file=sys.stderr)
     usage()
 
 # Set up our logger
 log = log_setup('main', loggingLevel)
+startup.mark('logging')
 
-def main():
+async def sample_cycle(supervisor, publishers, stores, packers, api_server):
+    """Every sleep_time seconds get the current data from every controller, store it, hand it to the publishers and
+    queue it to be sent as packed telemetry"""
+
+    loop = asyncio.get_event_loop()
+    next_run = loop.time()
+
+    while True:
+        # One pass over each controller's menus gets every reading, all controllers at once
+        snapshots = await supervisor.read_all()
+        now = time.time()
+        for tag, data in snapshots.items():
+            stores[tag].append(data, now)
+            publishers[tag].update(data)
+
+            body = packers[tag].add(data, now)
+            if body is None and packers[tag].age(now) >= pack_interval:
+                body = packers[tag].flush()
+            if body is not None:
+                await api_server.publish(body)
+            packers[tag].save(pack_file(tag))
+
+        log.debug('Waiting for next cycle')
+        next_run += sleep_time
+        await asyncio.sleep(max(0, next_run - loop.time()))
+
+
+def pack_file(tag):
+    """Where a controller's samples wait to be packed and sent"""
+
+    return os.path.join(pack_dir, tag + '.pack')
+
+
+async def export_metrics():
+    """Keep the metrics textfile up to date"""
+
+    while True:
+        try:
+            registry.write_textfile(metrics_file)
+        except (IOError, OSError) as e:
+            log.warning('Unable to write metrics: ' + str(e))
+        await asyncio.sleep(metrics_interval)
+
+
+async def wait_for_bus(supervisor):
+    """Note when every controller has been answered, the point the controller can no longer drop us"""
 
-    log.info('Creating ' + controller + ' interface on port ' + port)
-    iface = Interface(controller, port)
+    while not supervisor.acking():
+        await asyncio.sleep(0.05)
+
+    startup.mark('bus acking')
+    log.info('Answering every controller {0:.3f}s after start'.format(time.perf_counter() - startup.start))
+
+
+async def run():
+
+    loop = asyncio.get_event_loop()
+
+    # Each controller's bus is serviced on its own thread, so they are answering while the cloud side comes up
+    supervisor = Supervisor(controller, ports, captureFile)
+    supervisor.start(loop)
+    startup.mark('bus started')
+    bus_up = asyncio.ensure_future(wait_for_bus(supervisor))
+
+    # Local history of everything we sample
+    stores = {}
+    for tag in supervisor.tags():
+        stores[tag] = TimeSeriesStore(os.path.join(base_dir, 'data', tag), telemetry_fields)
+    startup.mark('stores')
+
+    # Outgoing messages wait on disk until they have been sent, so an outage loses nothing
+    spool = Spool(os.path.join(base_dir, 'spool'))
 
     log.info('Creating listening server')
-    api_server = ApiServer(baseName + 'rq.fifo', baseName + 'wq.fifo')
+    # Commands left over from before we started are dropped, not acted on
+    api_server = await loop.run_in_executor(
+        None, functools.partial(ApiServer, baseName + 'rq.fifo', baseName + 'wq.fifo', discard_stale=True,
+                                spool=spool))
+    api_server.register_metrics(registry)
+    startup.mark('cloud')
+
+    # Telemetry history, many samples to a message
+    packers = dict((tag, SamplePacker(telemetry_fields, tag)) for tag in supervisor.tags())
+    for tag, packer in packers.items():
+        count = packer.load(pack_file(tag))
+        if count:
+            log.info('Picked up {0} unsent {1} samples'.format(count, tag))
+
+    # Changes are published as they happen, with heartbeats while nothing changes
+    publishers = {}
+    for tag in supervisor.tags():
+        publishers[tag] = ChangePublisher(functools.partial(publish_tagged, api_server, tag), heartbeat=sleep_time)
+    supervisor.subscribe(lambda tag, changes: publishers[tag].update(changes))
+
+    # Commands from the read queue, answered with acks on the write queue
+    commands = CommandPipeline(supervisor, api_server.publish, stores)
 
-    server = threading.Thread(target=api_server.process_msg(), args=())
-    server.start()
+    # The same commands for local clients, with reads served from the state we already have
+    local_api = LocalApiServer(supervisor, commands, local_socket, localAddress)
+    local_api.register_metrics(registry)
+
+    # Stop cleanly on SIGTERM and ctrl-c
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
 
     log.debug('Entering main loop')
-    while True:
-        data = {}
-        data['air_temp'] = iface.get_temp('air')
-        data['pool_temp'] = iface.get_temp('pool')
-        data['spa_temp'] = iface.get_temp('spa')
+    startup.mark('main loop')
+    log.info(startup.summary())
+    bus_up.add_done_callback(lambda future: future.cancelled() or startup.register(registry))
+    tasks = [asyncio.ensure_future(api_server.process_msg(commands.submit)),
+             asyncio.ensure_future(commands.run()),
+             asyncio.ensure_future(local_api.run()),
+             asyncio.ensure_future(api_server.drain()),
+             asyncio.ensure_future(supervisor.monitor()),
+             asyncio.ensure_future(export_metrics()),
+             asyncio.ensure_future(sample_cycle(supervisor, publishers, stores, packers, api_server))]
+    tasks += [asyncio.ensure_future(publisher.run()) for publisher in publishers.values()]
+    waiter = asyncio.ensure_future(stop.wait())
 
-        log.info('Sending current pool data')
-        api_server.send_msg(data)
+    done, pending = await asyncio.wait(tasks + [waiter], return_when=asyncio.FIRST_COMPLETED)
 
-        log.debug('Waiting for next cycle')
-        sleep(sleep_time)
+    for task in pending:
+        task.cancel()
+    bus_up.cancel()
+    # Let the cancelled tasks unwind, and anything already being sent from the spool get there, before closing up
+    await asyncio.gather(bus_up, *pending, return_exceptions=True)
+    await api_server.wait_sent()
+    supervisor.stop()
+    for store in stores.values():
+        store.close()
+    for tag, packer in packers.items():
+        body = packer.flush()
+        if body is not None:
+            await api_server.publish(body)
+        packer.save(pack_file(tag))
+    spool.close()
+
+    # Let any task that failed raise its exception
+    for task in done:
+        task.result()
+
+
+async def publish_tagged(api_server, tag, snapshot):
+    """Publish a controller's state with the controller it came from"""
+
+    message = dict(snapshot)
+    message['controller'] = tag
+    await api_server.publish(message)
+
+
+def main():
 
+    asyncio.run(run())
 
     shutdown_logging()
     # the end
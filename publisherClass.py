@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+"""
+Publishes pool state when it changes rather than on a fixed timer.
+
+A change is sent straight away once a value has moved past its deadband from what was last published. Bursts of
+changes are held back to at most one message per min_interval, and a heartbeat goes out when nothing has changed
+for heartbeat seconds.
+"""
+
+from __future__ import (division, print_function)
+
+import asyncio
+import collections
+import logging
+import time
+
+
+class ChangePublisher(object):
+    """Decides when state is worth publishing"""
+
+    # Change needed before a value is published again, anything not listed is sent on any change
+    default_deadbands = {'air_temp': 2, 'pool_temp': 1, 'spa_temp': 1}
+
+    def __init__(self, publish, deadbands=None, heartbeat=600, min_interval=5):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        # Coroutine function that sends a snapshot dict
+        self.publish = publish
+
+        self.deadbands = ChangePublisher.default_deadbands if deadbands is None else deadbands
+        self.heartbeat = heartbeat
+        self.min_interval = min_interval
+
+        self.current = {}
+        self.published = {}
+        self.last_publish = 0.0
+        self.due = False
+        self.wakeup = None
+
+        self.counts = collections.Counter()
+
+    def update(self, changes):
+        """Feed in new values, from a state subscription or a full snapshot"""
+
+        self.current.update(changes)
+
+        if not self.due and self._significant(changes):
+            self.due = True
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+    def _significant(self, changes):
+        for name, value in changes.items():
+            if name not in self.published:
+                return True
+            old = self.published[name]
+            band = self.deadbands.get(name, 0)
+            if not band or isinstance(value, bool) or value is None or old is None:
+                if value != old:
+                    return True
+            elif abs(value - old) >= band:
+                return True
+        return False
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+
+        while True:
+            now = time.time()
+            if self.due:
+                send_at = self.last_publish + self.min_interval
+            else:
+                send_at = self.last_publish + self.heartbeat
+
+            if now >= send_at:
+                await self._send('change' if self.due else 'heartbeat')
+                continue
+
+            if self.due:
+                self.counts['held'] += 1
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), send_at - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, reason):
+        snapshot = dict(self.current)
+
+        self.published = snapshot
+        self.last_publish = time.time()
+        self.due = False
+        self.counts[reason] += 1
+
+        if not snapshot:
+            # Nothing read from the controller yet
+            return
+
+        self.log.info('Publishing pool state (' + reason + ')')
+        await self.publish(snapshot)
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+"""
+Reopens a serial port that has dropped out, e.g. a USB RS485 adapter resetting.
+
+Attempts back off exponentially, with some jitter, up to a maximum delay. The time from the fault to the controller
+talking to us again is recorded, since the controller drops a PDA that stops answering for too long.
+"""
+
+from __future__ import (division, print_function)
+
+import asyncio
+import logging
+import random
+import time
+
+import serial
+
+from metricsUtils import Histogram
+
+
+# Time to recover bucket upper bounds, in seconds
+recover_buckets = (0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Backoff(object):
+    """Delays between attempts, doubling each time.
+    The maximum is kept short, a PDA that is gone for long has to be registered again by the controller."""
+
+    def __init__(self, initial=0.1, maximum=5.0, factor=2.0, jitter=0.1):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.delay = initial
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def reset(self):
+        self.delay = self.initial
+
+
+class ReconnectManager(object):
+    """Tracks a port's faults and opens it again"""
+
+    # Errors that mean the port has gone rather than a bug in our code
+    errors = (serial.SerialException, OSError)
+
+    def __init__(self, opener, backoff=None):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        # Returns a newly opened port, raising one of errors if it can't
+        self.opener = opener
+        self.backoff = Backoff() if backoff is None else backoff
+
+        # perf_counter() time of the fault we are recovering from, None when up
+        self.lost_at = None
+
+        self.faults = 0
+        self.attempts = 0
+        self.recover_time = Histogram('time to recover', recover_buckets)
+
+    def lost(self, error):
+        if self.lost_at is None:
+            self.lost_at = time.perf_counter()
+            self.faults += 1
+            self.log.warning('Lost serial port: ' + str(error))
+
+    def _attempt(self):
+        self.attempts += 1
+        try:
+            return self.opener()
+        except ReconnectManager.errors as e:
+            self.log.debug('Reopen failed: ' + str(e))
+            return None
+
+    def open_blocking(self):
+        """Keep trying to open the port, sleeping between attempts"""
+
+        while True:
+            port = self._attempt()
+            if port is not None:
+                self.log.info('Reopened serial port')
+                return port
+            time.sleep(self.backoff.next())
+
+    async def open(self):
+        """Keep trying to open the port without blocking the event loop"""
+
+        while True:
+            port = self._attempt()
+            if port is not None:
+                self.log.info('Reopened serial port')
+                return port
+            await asyncio.sleep(self.backoff.next())
+
+    def recovered(self):
+        """Called on the first frame for us after a fault"""
+
+        if self.lost_at is None:
+            return
+
+        elapsed = time.perf_counter() - self.lost_at
+        self.lost_at = None
+        self.backoff.reset()
+        self.recover_time.observe(elapsed)
+        self.log.info('Recovered from serial fault in {0:.3f}s'.format(elapsed))
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+"""
+Replays a bus capture recorded with poolbot.py -r through the Aqualink decoder, either as fast as possible to measure
+decoder throughput or in real time to reproduce a field problem.
+"""
+
+from __future__ import (division, print_function)
+
+import sys
+import os
+import getopt
+import time
+
+from loggingUtils import log_setup, shutdown_logging
+from captureClass import CaptureReplay
+from aqualinkClass import Aqualink
+
+# Configuration
+
+# Find our current dir and set our base dir
+script_name = os.path.basename(__file__)
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Init our cmd line args
+captureFile = ''
+loggingLevel = ''
+realtime = False
+speed = 1.0
+process = False
+
+
+# Usage method
+def usage():
+    print('Usage: ./' + script_name + ' -f <capture file> [-t] [-s speed] [-x] [-d debug level]')
+    print('  -t  replay in real time, -s scales the replay speed')
+    print('  -x  also ACK and run each message through processMessage')
+    print('Example: ./' + script_name + ' -f overnight.cap')
+    sys.exit(2)
+
+# Parse command line arguments and set default values for some
+opts = []
+args = []
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'f:ts:xd:h', ['file=', 'realtime', 'speed=', 'process', 'debug=',
+                                                         'help'])
+except getopt.GetoptError:
+    usage()
+
+for opt, arg in opts:
+    if opt in ('-h', '--help'):
+        usage()
+    elif opt in ('-f', '--file'):
+        captureFile = arg
+    elif opt in ('-t', '--realtime'):
+        realtime = True
+    elif opt in ('-s', '--speed'):
+        speed = float(arg)
+    elif opt in ('-x', '--process'):
+        process = True
+    elif opt in ('-d', '--debug'):
+        loggingLevel = arg
+    else:
+        usage()
+
+if captureFile == '':
+    print('ERROR: Capture file must be provided', file=sys.stderr)
+    usage()
+
+# Set up our logger
+log = log_setup('replay', loggingLevel)
+
+
+def main():
+
+    replay = CaptureReplay(captureFile, realtime=realtime, speed=speed)
+    aqualink = Aqualink(captureFile, port=replay)
+
+    start = time.time()
+    count = 0
+    try:
+        for frame in aqualink.frames:
+            count += 1
+            if process:
+                aqualink.handleFrame(frame)
+    except EOFError:
+        pass
+
+    elapsed = time.time() - start
+    stats = aqualink.decoder.stats()
+
+    log.info('Replayed {0} frames ({1} bytes) in {2:.3f}s'.format(count, stats['bytes'], elapsed))
+    if elapsed > 0:
+        log.info('Throughput: {0:.0f} frames/s, {1:.0f} bytes/s'.format(count / elapsed, stats['bytes'] / elapsed))
+    log.info('Bad checksums: {0}, resyncs: {1}'.format(stats['bad_checksums'], stats['resyncs']))
+    if process:
+        aqualink.screen.flush()
+        log.info(aqualink.acks.latency.summary())
+
+    replay.close()
+    shutdown_logging()
+
+# Execute as standalone program
+if __name__ == '__main__':
+    try:
+        main()
+    except:
+        log.exception('Exception')
+        raise
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+"""
+Virtual copy of the PDA remote screen.
+
+The controller draws on the PDA with clear, write line, scroll and invert commands. The screen is kept as a fixed
+rows x cols bytearray of characters plus a bitmap of inverted (highlighted) cells, updated in place. Lines that
+change are marked dirty and flush() hands only those lines to subscribers.
+"""
+
+from __future__ import (division, print_function)
+
+import logging
+
+
+class Screen(object):
+    """Fixed size character screen with an invert bitmap and dirty line tracking"""
+
+    rows = 10
+    cols = 16
+
+    # Direction byte of the scroll command that moves lines up the screen
+    scroll_up = 0xff
+
+    def __init__(self):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.text = bytearray(b' ' * (Screen.rows * Screen.cols))
+        self.view = memoryview(self.text)
+
+        # One bit per cell
+        self.row_bytes = (Screen.cols + 7) // 8
+        self.invert = bytearray(Screen.rows * self.row_bytes)
+
+        # Bit n set when row n changed since the last flush
+        self.dirty = 0
+        self.status = b''
+        self.status_dirty = False
+
+        # Bumped on every flush that had changes
+        self.version = 0
+
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """callback(screen, lines) is called from flush() with a {row: text} dict of changed lines"""
+
+        self.subscribers.append(callback)
+
+    def _row(self, row):
+        return self.view[row * Screen.cols:(row + 1) * Screen.cols]
+
+    def line(self, row):
+        """Text of a row as a str, trailing spaces removed"""
+
+        return self._row(row).tobytes().decode('latin-1').rstrip()
+
+    def lines(self):
+        return [self.line(row) for row in range(Screen.rows)]
+
+    def cls(self):
+        """Clear the whole screen"""
+
+        self.text[:] = b' ' * len(self.text)
+        self.invert[:] = bytes(len(self.invert))
+        self.dirty = (1 << Screen.rows) - 1
+
+    def write_line(self, row, text):
+        """Replace a row with text, padded or cut to the screen width"""
+
+        if not 0 <= row < Screen.rows:
+            self.log.debug('Write to line ' + str(row) + ' is off the screen')
+            return
+
+        text = bytes(text[:Screen.cols]).ljust(Screen.cols)
+        line = self._row(row)
+        if line != text:
+            line[:] = text
+            self.dirty |= 1 << row
+
+    def scroll(self, start, end, direction):
+        """Shift rows start..end (inclusive) up or down by one line, the row shifted in is blank"""
+
+        end = min(end, Screen.rows - 1)
+        if not 0 <= start < end:
+            return
+
+        cols = Screen.cols
+        width = self.row_bytes
+        if direction == Screen.scroll_up:
+            self.view[start * cols:end * cols] = self.view[(start + 1) * cols:(end + 1) * cols]
+            self.invert[start * width:end * width] = self.invert[(start + 1) * width:(end + 1) * width]
+            blank = end
+        else:
+            self.view[(start + 1) * cols:(end + 1) * cols] = self.view[start * cols:end * cols]
+            self.invert[(start + 1) * width:(end + 1) * width] = self.invert[start * width:end * width]
+            blank = start
+
+        self.view[blank * cols:(blank + 1) * cols] = b' ' * cols
+        self.invert[blank * width:(blank + 1) * width] = bytes(width)
+
+        self.dirty |= ((1 << (end + 1)) - 1) & ~((1 << start) - 1)
+
+    def _clear_invert(self):
+        for row in range(Screen.rows):
+            if any(self.invert[row * self.row_bytes:(row + 1) * self.row_bytes]):
+                self.dirty |= 1 << row
+        self.invert[:] = bytes(len(self.invert))
+
+    def invert_chars(self, row, start, end):
+        """Highlight cells start..end (inclusive) of a row, only one highlight is shown at a time"""
+
+        if not 0 <= row < Screen.rows:
+            return
+
+        self._clear_invert()
+
+        base = row * self.row_bytes
+        for col in range(start, min(end, Screen.cols - 1) + 1):
+            self.invert[base + col // 8] |= 0x80 >> (col % 8)
+
+        self.dirty |= 1 << row
+
+    def invert_line(self, row):
+        """Highlight a whole row"""
+
+        self.invert_chars(row, 0, Screen.cols - 1)
+
+    def is_inverted(self, row, col):
+        return bool(self.invert[row * self.row_bytes + col // 8] & (0x80 >> (col % 8)))
+
+    def highlighted(self):
+        """Row that is currently highlighted, or None"""
+
+        for row in range(Screen.rows):
+            if any(self.invert[row * self.row_bytes:(row + 1) * self.row_bytes]):
+                return row
+        return None
+
+    def set_status(self, status):
+        status = bytes(status)
+        if status != self.status:
+            self.status = status
+            self.status_dirty = True
+
+    def flush(self):
+        """Send the lines changed since the last flush to the subscribers"""
+
+        if not self.dirty and not self.status_dirty:
+            return
+
+        lines = {}
+        dirty = self.dirty
+        row = 0
+        while dirty:
+            if dirty & 1:
+                lines[row] = self.line(row)
+            dirty >>= 1
+            row += 1
+
+        self.dirty = 0
+        self.status_dirty = False
+        self.version += 1
+
+        for callback in self.subscribers:
+            callback(self, lines)
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
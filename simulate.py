@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+"""
+Load tests the Aqualink PDA emulation against a simulated master controller on a pty, no pool required. Reports the
+frame rate reached, how quickly frames were ACKed and anything answered that should not have been.
+"""
+
+from __future__ import (division, print_function)
+
+import sys
+import os
+import getopt
+import asyncio
+
+import serial
+
+from loggingUtils import log_setup, shutdown_logging
+from simulatorClass import MasterSimulator
+from aqualinkClass import Aqualink
+
+# Configuration
+
+# Find our current dir and set our base dir
+script_name = os.path.basename(__file__)
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Init our cmd line args
+loggingLevel = ''
+rate = 100.0
+duration = 10.0
+noise = 0.0
+bad = 0.0
+others = 0.2
+
+
+# Usage method
+def usage():
+    print('Usage: ./' + script_name + ' [-r rate] [-n seconds] [-z noise] [-b bad] [-o others] [-d debug level]')
+    print('  -r  frames/s sent to the PDA, 0 for as fast as it answers')
+    print('  -z, -b, -o  chance of line noise, a bad checksum or another device\'s frame before each frame')
+    print('Example: ./' + script_name + ' -r 0 -n 30 -z 0.05 -b 0.05')
+    sys.exit(2)
+
+# Parse command line arguments and set default values for some
+opts = []
+args = []
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'r:n:z:b:o:d:h', ['rate=', 'seconds=', 'noise=', 'bad=', 'others=',
+                                                              'debug=', 'help'])
+except getopt.GetoptError:
+    usage()
+
+for opt, arg in opts:
+    if opt in ('-h', '--help'):
+        usage()
+    elif opt in ('-r', '--rate'):
+        rate = float(arg)
+    elif opt in ('-n', '--seconds'):
+        duration = float(arg)
+    elif opt in ('-z', '--noise'):
+        noise = float(arg)
+    elif opt in ('-b', '--bad'):
+        bad = float(arg)
+    elif opt in ('-o', '--others'):
+        others = float(arg)
+    elif opt in ('-d', '--debug'):
+        loggingLevel = arg
+    else:
+        usage()
+
+# Set up our logger
+log = log_setup('simulate', loggingLevel)
+
+
+async def run(simulator, aqualink):
+
+    loop = asyncio.get_event_loop()
+    aqualink.attach(loop)
+
+    simulator.start(duration)
+    await loop.run_in_executor(None, simulator.thread.join)
+
+    aqualink.detach(loop)
+
+
+def main():
+
+    simulator = MasterSimulator(rate=rate, noise=noise, bad=bad, others=others)
+    log.info('Simulated controller on ' + simulator.slave_name)
+
+    port = serial.Serial(simulator.slave_name, baudrate=9600,
+                         bytesize=serial.EIGHTBITS,
+                         parity=serial.PARITY_NONE,
+                         stopbits=serial.STOPBITS_ONE,
+                         timeout=None)
+    aqualink = Aqualink(simulator.slave_name, port=port)
+
+    asyncio.run(run(simulator, aqualink))
+
+    for line in simulator.report():
+        log.info(line)
+    stats = aqualink.decoder.stats()
+    log.info('PDA side: {0} frames, {1} bad checksums, {2} resyncs'.format(
+        stats['frames'], stats['bad_checksums'], stats['resyncs']))
+    log.info(aqualink.acks.latency.summary())
+
+    passed = simulator.passed()
+    log.info('PASSED' if passed else 'FAILED')
+
+    port.close()
+    simulator.close()
+    shutdown_logging()
+
+    sys.exit(0 if passed else 1)
+
+# Execute as standalone program
+if __name__ == '__main__':
+    try:
+        main()
+    except SystemExit:
+        raise
+    except:
+        log.exception('Exception')
+        raise
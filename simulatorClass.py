@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+"""
+Simulated Jandy Aqualink master controller on a Linux pseudo terminal.
+
+The simulator owns the master side of a pty and the PDA code under test opens the slave side like any serial port.
+It sends a mix of probes, screen writes, scrolls, inverts and status frames to the PDA address at a set rate, along
+with traffic for other devices, line noise, frames that lean on DLE stuffing and frames with bad checksums. Every
+valid frame to the PDA must be answered with an ACK within the deadline, and nothing else may be answered.
+"""
+
+from __future__ import (division, print_function)
+
+import collections
+import logging
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+from frameDecoderClass import FrameDecoder
+from frameEncoderClass import FrameEncoder
+from metricsUtils import Histogram
+
+
+class MasterSimulator(object):
+    """Drives a PDA over a pty and checks its replies"""
+
+    masterAddr = 0x00
+    pdaAddr = 0x60
+    ackCmd = 0x01
+
+    # Other devices on a real bus, probed but never answered by the PDA
+    otherAddrs = (0x08, 0x33, 0x48)
+
+    # Relative weights of the frames sent to the PDA
+    mix = (('probe', 40), ('write', 30), ('status', 10), ('scroll', 5), ('invert_line', 5), ('invert_chars', 5),
+           ('cls', 5))
+
+    rows = 10
+    cols = 16
+
+    def __init__(self, rate=100.0, noise=0.0, bad=0.0, others=0.2, deadline=0.01, timeout=0.1, seed=None):
+        """rate is frames per second to the PDA, 0 to send the next one as soon as the last is answered.
+        noise, bad and others are the chance of line noise, a corrupt frame or another device's frame between
+        frames to the PDA. Replies later than deadline are late, none after timeout is a miss."""
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.rate = rate
+        self.noise = noise
+        self.bad = bad
+        self.others = others
+        self.deadline = deadline
+        self.timeout = timeout
+        self.random = random.Random(seed)
+
+        self.master, slave = os.openpty()
+        tty.setraw(self.master)
+        self.slave_name = os.ttyname(slave)
+        # Keep the slave open so the pty survives the PDA closing and reopening it
+        self.slave = slave
+
+        self.encoder = FrameEncoder()
+        self.decoder = FrameDecoder()
+
+        self.kinds = [kind for kind, weight in MasterSimulator.mix]
+        self.weights = [weight for kind, weight in MasterSimulator.mix]
+
+        self.latency = Histogram('simulated ack latency')
+        self.counts = collections.Counter()
+        self.keys = collections.Counter()
+
+        self.running = False
+        self.thread = None
+
+    def _text(self):
+        """A line of screen text, sometimes with DLEs in it, including DLE ETX"""
+
+        choice = self.random.random()
+        if choice < 0.1:
+            return b'A\x10\x03B\x10\x10C'
+        if choice < 0.2:
+            return bytes(self.random.choice(b'0123456789\x10') for i in range(MasterSimulator.cols))
+        return bytes(self.random.choice(b' ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789`') for i in range(MasterSimulator.cols))
+
+    @staticmethod
+    def _pad_to_dle(dest, cmd, args):
+        """Extend args so the frame checksum comes out as a DLE and has to be stuffed"""
+
+        pad = (0x10 - FrameEncoder.checksum(bytes((dest, cmd)) + args)) & 0xff
+        return args + bytes((pad,))
+
+    def _pda_frame(self):
+        kind = self.random.choices(self.kinds, self.weights)[0]
+
+        if kind == 'probe':
+            cmd, args = 0x00, b''
+        elif kind == 'write':
+            line = self.random.choice((0x40, 0x82) + tuple(range(MasterSimulator.rows)))
+            cmd, args = 0x04, bytes((line,)) + self._text() + b'\x00'
+        elif kind == 'status':
+            cmd, args = 0x02, bytes(self.random.randrange(256) for i in range(5))
+        elif kind == 'scroll':
+            start = self.random.randrange(1, MasterSimulator.rows - 1)
+            cmd, args = 0x0f, bytes((start, MasterSimulator.rows - 1, self.random.choice((0x01, 0xff))))
+        elif kind == 'invert_line':
+            cmd, args = 0x08, bytes((self.random.randrange(MasterSimulator.rows),))
+        elif kind == 'invert_chars':
+            start = self.random.randrange(MasterSimulator.cols)
+            cmd, args = 0x10, bytes((self.random.randrange(MasterSimulator.rows), start,
+                                     self.random.randrange(start, MasterSimulator.cols)))
+        else:
+            cmd, args = 0x09, b'\x00'
+
+        if kind != 'probe' and self.random.random() < 0.05:
+            args = MasterSimulator._pad_to_dle(MasterSimulator.pdaAddr, cmd, args)
+
+        self.counts[kind] += 1
+        return self.encoder.encode(MasterSimulator.pdaAddr, cmd, args)
+
+    @staticmethod
+    def _corrupt(frame):
+        """Same frame with the checksum off by one"""
+
+        if frame[-4:-2] == b'\x10\x00':
+            return frame[:-4] + b'\x11' + frame[-2:]
+        checksum = (frame[-3] + 1) & 0xff
+        return frame[:-3] + (b'\x10\x00' if checksum == 0x10 else bytes((checksum,))) + frame[-2:]
+
+    def _noise(self):
+        """Random bytes, sometimes a frame cut off part way"""
+
+        if self.random.random() < 0.3:
+            frame = self.encoder.encode(MasterSimulator.pdaAddr, 0x04, b'\x01' + self._text())
+            return frame[:self.random.randrange(2, len(frame) - 2)]
+        return bytes(self.random.randrange(256) for i in range(self.random.randrange(1, 8)))
+
+    def traffic(self, count):
+        """count frames to the PDA with the other traffic step() would send around them, as a list of the chunks
+        that would be written to the bus, for feeding straight into a decoder"""
+
+        chunks = []
+        for i in range(count):
+            if self.random.random() < self.noise:
+                chunks.append(self._noise())
+            if self.random.random() < self.others:
+                chunks.append(self.encoder.encode(self.random.choice(MasterSimulator.otherAddrs), 0x00))
+            if self.random.random() < self.bad:
+                chunks.append(MasterSimulator._corrupt(self._pda_frame()))
+            chunks.append(self._pda_frame())
+        return chunks
+
+    def _write(self, data):
+        os.write(self.master, data)
+        self.counts['bytes'] += len(data)
+
+    def _read(self, until):
+        """Decode whatever the PDA sends before until, returns its replies as (time, args)"""
+
+        replies = []
+        while True:
+            wait = until - time.perf_counter()
+            ready, _, _ = select.select([self.master], [], [], max(wait, 0))
+            if not ready:
+                return replies
+
+            now = time.perf_counter()
+            self.decoder.feed(os.read(self.master, 1024))
+            for frame in self.decoder.frames():
+                if frame[0] == MasterSimulator.masterAddr and frame[1] == MasterSimulator.ackCmd:
+                    replies.append((now, frame[2:].tobytes()))
+                else:
+                    self.counts['unexpected'] += 1
+            if replies:
+                return replies
+
+    def _expect_none(self, what):
+        """Give the PDA a moment to wrongly answer something it should ignore"""
+
+        for when, args in self._read(time.perf_counter() + self.deadline):
+            self.counts['answered ' + what] += 1
+
+    def step(self):
+        """Send one frame to the PDA, with whatever else the bus carries before it, and check the reply"""
+
+        if self.random.random() < self.noise:
+            self._write(self._noise())
+            self.counts['noise'] += 1
+        if self.random.random() < self.others:
+            self._write(self.encoder.encode(self.random.choice(MasterSimulator.otherAddrs), 0x00))
+            self.counts['other'] += 1
+            self._expect_none('other device')
+        if self.random.random() < self.bad:
+            self._write(MasterSimulator._corrupt(self._pda_frame()))
+            self.counts['bad'] += 1
+            self._expect_none('bad checksum')
+
+        frame = self._pda_frame()
+        self._write(frame)
+        sent = time.perf_counter()
+        self.counts['sent'] += 1
+
+        replies = self._read(sent + self.timeout)
+        if not replies:
+            self.counts['missed'] += 1
+            return
+
+        when, args = replies[0]
+        elapsed = when - sent
+        self.latency.observe(elapsed)
+        self.counts['acked'] += 1
+        if elapsed > self.deadline:
+            self.counts['late'] += 1
+        if len(args) == 2 and args[1]:
+            self.keys[args[1]] += 1
+        if len(replies) > 1:
+            self.counts['extra acks'] += len(replies) - 1
+
+    def run(self, duration):
+        """Drive the PDA for duration seconds, or until stop()"""
+
+        self.running = True
+        started = time.perf_counter()
+        next_send = started
+
+        while self.running and time.perf_counter() - started < duration:
+            self.step()
+            if self.rate:
+                next_send += 1 / self.rate
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+        self.counts['seconds'] = time.perf_counter() - started
+        self.running = False
+
+    def start(self, duration):
+        self.thread = threading.Thread(target=self.run, args=(duration,), name='simulator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def report(self):
+        """Results as a list of log lines"""
+
+        counts = self.counts
+        seconds = counts['seconds'] or 1
+        lines = ['Sent {0} frames to the PDA in {1:.1f}s, {2:.0f} frames/s, {3:.0f} bytes/s'.format(
+                     counts['sent'], counts['seconds'], counts['sent'] / seconds, counts['bytes'] / seconds),
+                 'Mix: ' + ', '.join('{0} {1}'.format(kind, counts[kind]) for kind in self.kinds),
+                 'Also sent: {0} other device, {1} bad checksum, {2} noise'.format(
+                     counts['other'], counts['bad'], counts['noise']),
+                 'ACKed {0}, late {1} (over {2:.0f}ms), missed {3}'.format(
+                     counts['acked'], counts['late'], self.deadline * 1000, counts['missed']),
+                 'Wrongly answered: {0} other device, {1} bad checksum, {2} extra ACKs, {3} unexpected frames'.format(
+                     counts['answered other device'], counts['answered bad checksum'], counts['extra acks'],
+                     counts['unexpected']),
+                 self.latency.summary()]
+        if self.keys:
+            lines.append('Keys pressed: ' + ', '.join('{0:02x} x{1}'.format(k, n) for k, n in sorted(self.keys.items())))
+        return lines
+
+    def passed(self):
+        """True when every frame was answered in time and nothing else was"""
+
+        counts = self.counts
+        return not (counts['missed'] or counts['late'] or counts['answered other device'] or
+                    counts['answered bad checksum'] or counts['extra acks'] or counts['unexpected'])
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
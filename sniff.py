@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+"""
+Listens to every device on the Aqualink bus without taking part, from a serial port or a capture file, and reports
+what each one is doing. Pumps, chlorinators and the like report RPM, watts and salt level this way with no menu
+navigation.
+"""
+
+from __future__ import (division, print_function)
+
+import sys
+import os
+import getopt
+import asyncio
+import json
+
+import serial
+
+from loggingUtils import log_setup, shutdown_logging
+from sniffClass import BusSniffer, device_types
+from captureClass import CaptureReplay
+
+# Configuration
+
+# Find our current dir and set our base dir
+script_name = os.path.basename(__file__)
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Init our cmd line args
+port = ''
+captureFile = ''
+addrs = None
+interval = 60
+loggingLevel = ''
+
+
+# Usage method
+def usage():
+    print('Usage: ./' + script_name + ' -p <port> | -f <capture file> [-a addrs] [-i interval] [-d debug level]')
+    print('  -a  comma separated hex addresses or device types to follow, default everything')
+    print('      types: ' + ', '.join(kind for first, last, kind in device_types))
+    print('  -i  seconds between reports when listening to a port')
+    print('Example: ./' + script_name + ' -p /dev/ttyUSB0 -a pump,chlorinator')
+    sys.exit(2)
+
+# Parse command line arguments and set default values for some
+opts = []
+args = []
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'p:f:a:i:d:h', ['port=', 'file=', 'addrs=', 'interval=', 'debug=',
+                                                            'help'])
+except getopt.GetoptError:
+    usage()
+
+for opt, arg in opts:
+    if opt in ('-h', '--help'):
+        usage()
+    elif opt in ('-p', '--port'):
+        port = arg
+    elif opt in ('-f', '--file'):
+        captureFile = arg
+    elif opt in ('-a', '--addrs'):
+        addrs = []
+        for item in arg.split(','):
+            ranges = [(first, last) for first, last, kind in device_types if kind == item]
+            if ranges:
+                addrs += range(ranges[0][0], ranges[0][1] + 1)
+            else:
+                try:
+                    addrs.append(int(item, 16))
+                except ValueError:
+                    usage()
+    elif opt in ('-i', '--interval'):
+        interval = float(arg)
+    elif opt in ('-d', '--debug'):
+        loggingLevel = arg
+    else:
+        usage()
+
+if (port == '') == (captureFile == ''):
+    print('ERROR: One of port or capture file must be provided', file=sys.stderr)
+    usage()
+
+# Set up our logger
+log = log_setup('sniff', loggingLevel)
+
+
+def report(sniffer):
+    for addr, device in sniffer.snapshot().items():
+        log.info(json.dumps(device, sort_keys=True))
+    stats = sniffer.decoder.stats()
+    log.info('{0} frames, {1} skipped, {2} bad checksums, {3} orphan replies'.format(
+        stats['frames'], stats['rejected'], stats['bad_checksums'], sniffer.orphan_replies))
+
+
+async def listen(sniffer):
+
+    loop = asyncio.get_event_loop()
+    sniffer.attach(loop)
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            report(sniffer)
+    finally:
+        sniffer.detach(loop)
+
+
+def main():
+
+    if captureFile != '':
+        replay = CaptureReplay(captureFile)
+        sniffer = BusSniffer(replay, addrs)
+        sniffer.run()
+        report(sniffer)
+        replay.close()
+    else:
+        sniffer = BusSniffer(serial.Serial(port, baudrate=9600,
+                                           bytesize=serial.EIGHTBITS,
+                                           parity=serial.PARITY_NONE,
+                                           stopbits=serial.STOPBITS_ONE,
+                                           timeout=None), addrs)
+        sniffer.subscribe(lambda device, changes: log.info('%02x %s: %s' % (device.addr, device.kind, changes)))
+        try:
+            asyncio.run(listen(sniffer))
+        except KeyboardInterrupt:
+            report(sniffer)
+
+    shutdown_logging()
+
+# Execute as standalone program
+if __name__ == '__main__':
+    try:
+        main()
+    except:
+        log.exception('Exception')
+        raise
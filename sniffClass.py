@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+"""
+Listen-only decoding of every device on the Aqualink bus.
+
+The master addresses each device in turn and the device answers with a frame to the master, so a reply belongs to
+whichever device was addressed last. Every device seen gets a cache of the last arguments of each command sent to it
+and each reply it made, plus fields decoded from them for the device types we understand, e.g. salt level from a
+chlorinator or RPM and watts from a variable speed pump.
+
+Nothing is ever written to the bus. Addresses we are not interested in are dropped by the decoder before the frame is
+unstuffed or checksummed, so following a handful of devices costs little more than finding frame boundaries.
+"""
+
+from __future__ import (division, print_function)
+
+import logging
+import struct
+import time
+
+from frameDecoderClass import FrameDecoder
+
+
+masterAddr = 0x00
+
+# First address, last address and type of the devices that can be on the bus
+device_types = ((0x08, 0x0b, 'keypad'),
+                (0x40, 0x43, 'onetouch'),
+                (0x50, 0x53, 'chlorinator'),
+                (0x60, 0x63, 'pda'),
+                (0x68, 0x6b, 'heater'),
+                (0x78, 0x7b, 'pump'))
+
+# Chlorinator commands and replies
+swg_percent_cmd = 0x11
+swg_status_cmd = 0x16
+
+# Pump reply, and the request it is answering as its first argument
+pump_status_cmd = 0x1f
+pump_rpm = 0x44
+pump_watts = 0x45
+pump_value = struct.Struct('<BxH')
+
+
+def device_type(addr):
+    for first, last, kind in device_types:
+        if first <= addr <= last:
+            return kind
+    return 'unknown'
+
+
+def decode_chlorinator(device, reply, cmd, args):
+    if not reply and cmd == swg_percent_cmd and len(args) >= 1:
+        return {'percent': args[0]}
+    if reply and cmd == swg_status_cmd and len(args) >= 2:
+        return {'salt_ppm': args[0] * 100, 'status': args[1]}
+    return None
+
+
+def decode_pump(device, reply, cmd, args):
+    if reply and cmd == pump_status_cmd and len(args) >= pump_value.size:
+        request, value = pump_value.unpack_from(args)
+        if request == pump_rpm:
+            return {'rpm': value // 4}
+        if request == pump_watts:
+            return {'watts': value}
+    return None
+
+
+# Device type: function(device, reply, cmd, args) returning a dict of decoded fields or None
+decoders = {'chlorinator': decode_chlorinator,
+            'pump': decode_pump}
+
+
+class Device(object):
+    """What we have seen of one device on the bus"""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.kind = device_type(addr)
+        self.decoder = decoders.get(self.kind)
+
+        # Last arguments of each command to the device and each reply from it, by command
+        self.commands = {}
+        self.replies = {}
+
+        # Decoded values
+        self.fields = {}
+
+        self.frames = 0
+        self.answered = 0
+        self.last_seen = 0.0
+
+    def seen(self, reply, cmd, args, now):
+        """Cache a frame to or from the device, returns the fields that changed"""
+
+        self.last_seen = now
+        if reply:
+            self.answered += 1
+            cache = self.replies
+        else:
+            self.frames += 1
+            cache = self.commands
+
+        # Only copy the args out of the decoder buffer when they change
+        old = cache.get(cmd)
+        if old is not None and old == args:
+            return None
+        cache[cmd] = bytes(args)
+
+        if self.decoder is None:
+            return None
+        decoded = self.decoder(self, reply, cmd, args)
+        if not decoded:
+            return None
+
+        changes = dict((k, v) for k, v in decoded.items() if self.fields.get(k) != v)
+        self.fields.update(changes)
+        return changes
+
+    def snapshot(self):
+        return {'addr': '%02x' % self.addr,
+                'type': self.kind,
+                'frames': self.frames,
+                'answered': self.answered,
+                'last_seen': self.last_seen,
+                'fields': dict(self.fields)}
+
+
+class BusSniffer(object):
+    """Follows the traffic for every device, or just the addresses given"""
+
+    def __init__(self, port, addrs=None):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.port = port
+        self.decoder = FrameDecoder(port)
+
+        if addrs is not None:
+            # The master has to be kept for the replies
+            accept = bytearray(256)
+            for addr in list(addrs) + [masterAddr]:
+                accept[addr] = 1
+            self.decoder.accept = bytes(accept)
+
+        self.devices = {}
+        self.subscribers = []
+
+        # Device the master addressed last, and the decoder's rejected count at the time
+        self.talking = None
+        self.rejected_mark = 0
+
+        self.orphan_replies = 0
+        self.readerFd = None
+
+    def subscribe(self, callback):
+        """callback(device, changes) is called whenever decoded fields change"""
+
+        self.subscribers.append(callback)
+
+    def handle(self, body, now=None):
+        """Account for one decoded frame body"""
+
+        if now is None:
+            now = time.time()
+
+        dest = body[0]
+        if dest == masterAddr:
+            device = self.talking
+            if device is None or self.decoder.rejected != self.rejected_mark:
+                # The reply is to something we skipped, or we never saw the question
+                self.orphan_replies += 1
+                return
+            self.talking = None
+            changes = device.seen(True, body[1], body[2:], now)
+        else:
+            device = self.devices.get(dest)
+            if device is None:
+                device = self.devices[dest] = Device(dest)
+                self.log.info('Found ' + device.kind + ' at %02x' % dest)
+            self.talking = device
+            self.rejected_mark = self.decoder.rejected
+            changes = device.seen(False, body[1], body[2:], now)
+
+        if changes:
+            for callback in self.subscribers:
+                callback(device, changes)
+
+    def poll(self):
+        """Called by the event loop when the port is readable"""
+
+        self.decoder.fill()
+        now = time.time()
+        for body in self.decoder.frames():
+            self.handle(body, now)
+
+    def run(self):
+        """Decode until the port runs dry, e.g. the end of a capture replay"""
+
+        try:
+            while True:
+                self.poll()
+        except EOFError:
+            pass
+
+    def attach(self, loop):
+        self.port.timeout = 0
+        self.readerFd = self.port.fileno()
+        loop.add_reader(self.readerFd, self.poll)
+        self.log.info('Listening to the bus')
+
+    def detach(self, loop):
+        if self.readerFd is not None:
+            loop.remove_reader(self.readerFd)
+            self.readerFd = None
+
+    def snapshot(self):
+        """State of every device seen, by address"""
+
+        return dict(('%02x' % addr, device.snapshot()) for addr, device in sorted(self.devices.items()))
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
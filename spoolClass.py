@@ -0,0 +1,279 @@
+#!/usr/bin/python
+
+"""
+Durable local spool of outgoing messages, so nothing is lost while the cloud can't be reached.
+
+Messages are appended to fixed size segment files that are memory mapped, so an append is a copy into the page cache
+and never waits on the network or the disk. A sender reads batches from the oldest unsent message, and commits them
+once they are delivered. Disk use is bounded by a number of segments: when it is full the oldest segment is dropped,
+unsent messages and all, so the newest data is kept.
+
+Segment files are named by sequence number and hold records of
+
+    <length:u32> <crc32:u32> <message bytes>
+
+with the unused tail left zero filled, so the end of the data in a segment is the first zero length or bad record.
+The position of the oldest unsent message is kept in a small cursor file.
+"""
+
+from __future__ import (division, print_function)
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+record_fmt = struct.Struct('<II')
+cursor_fmt = struct.Struct('<QQ')
+
+
+class Segment(object):
+    """One memory mapped segment file"""
+
+    def __init__(self, filename, size=None):
+
+        self.filename = filename
+
+        if size is not None:
+            self.fh = open(filename, 'w+b')
+            self.fh.truncate(size)
+        else:
+            self.fh = open(filename, 'r+b')
+
+        self.map = mmap.mmap(self.fh.fileno(), 0)
+        self.size = len(self.map)
+
+        # Offset just past the last good record, and how many records there are
+        self.end = 0
+        self.count = 0
+        offset = 0
+        while True:
+            record = self.read(offset)
+            if record is None:
+                break
+            offset = record[1]
+            self.end = offset
+            self.count += 1
+
+    def read(self, offset):
+        """(message, offset of the next record), or None at the end of the data"""
+
+        if offset + record_fmt.size > self.size:
+            return None
+
+        length, crc = record_fmt.unpack_from(self.map, offset)
+        start = offset + record_fmt.size
+        if not length or start + length > self.size:
+            return None
+
+        data = self.map[start:start + length]
+        if zlib.crc32(data) != crc:
+            return None
+
+        return data, start + length
+
+    def append(self, data):
+        """Add a message, returns False if it does not fit"""
+
+        start = self.end + record_fmt.size
+        if start + len(data) > self.size:
+            return False
+
+        self.map[start:start + len(data)] = data
+        record_fmt.pack_into(self.map, self.end, len(data), zlib.crc32(data))
+        self.end = start + len(data)
+        self.count += 1
+        return True
+
+    def sync(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.fh.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.filename)
+
+
+class Spool(object):
+    """Append-only segment log of outgoing messages with a read cursor"""
+
+    def __init__(self, path, segment_size=1048576, max_bytes=67108864):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_bytes // segment_size)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # Appends come from the event loop while a sender reads and commits from an executor thread
+        self.lock = threading.Lock()
+
+        # Sequence number: Segment, oldest first
+        self.segments = {}
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.seg'):
+                self.segments[int(name[:-4])] = Segment(os.path.join(path, name))
+        if not self.segments:
+            self.segments[1] = Segment(self._filename(1), segment_size)
+        self.tail = max(self.segments)
+
+        # Oldest unsent message, as (sequence number, offset)
+        self.cursor_file = os.path.join(path, 'cursor')
+        self.cursor = self._load_cursor()
+
+        self.dropped = 0
+        self.pending = self._count_pending()
+
+        self.log.info('Spool at ' + path + ' has ' + str(self.pending) + ' unsent messages')
+
+    def _filename(self, seq):
+        return os.path.join(self.path, '%08d.seg' % seq)
+
+    def _load_cursor(self):
+        first = min(self.segments)
+        try:
+            with open(self.cursor_file, 'rb') as fh:
+                seq, offset = cursor_fmt.unpack(fh.read(cursor_fmt.size))
+        except (IOError, struct.error):
+            return first, 0
+
+        if seq not in self.segments:
+            return first, 0
+        return seq, offset
+
+    def _save_cursor(self):
+        tmp = self.cursor_file + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(cursor_fmt.pack(*self.cursor))
+        os.replace(tmp, self.cursor_file)
+
+    def _count_pending(self):
+        seq, offset = self.cursor
+        count = 0
+        for s in sorted(self.segments):
+            if s < seq:
+                continue
+            segment = self.segments[s]
+            if s > seq:
+                count += segment.count
+                continue
+            while True:
+                record = segment.read(offset)
+                if record is None:
+                    break
+                offset = record[1]
+                count += 1
+        return count
+
+    def append(self, message):
+        """Spool a message (str or bytes)"""
+
+        data = message.encode('utf-8') if isinstance(message, str) else bytes(message)
+        if not data or len(data) + record_fmt.size > self.segment_size:
+            self.log.error('Message of ' + str(len(data)) + ' bytes can not be spooled')
+            return
+
+        with self.lock:
+            if not self.segments[self.tail].append(data):
+                self._roll()
+                self.segments[self.tail].append(data)
+            self.pending += 1
+
+    def _roll(self):
+        """Start a new segment, dropping the oldest if we are at the limit"""
+
+        self.segments[self.tail].sync()
+        self.tail += 1
+        self.segments[self.tail] = Segment(self._filename(self.tail), self.segment_size)
+
+        while len(self.segments) > self.max_segments:
+            oldest = min(self.segments)
+            segment = self.segments.pop(oldest)
+
+            if self.cursor[0] == oldest:
+                lost = 0
+                offset = self.cursor[1]
+                while True:
+                    record = segment.read(offset)
+                    if record is None:
+                        break
+                    offset = record[1]
+                    lost += 1
+                self.cursor = (min(self.segments), 0)
+                self.dropped += lost
+                self.pending -= lost
+                self.log.warning('Spool full, dropped ' + str(lost) + ' unsent messages')
+
+            segment.remove()
+
+    def peek(self, max_count, max_bytes):
+        """Up to max_count messages totalling no more than max_bytes from the oldest unsent.
+        Returns (messages, position to commit once they are sent)."""
+
+        messages = []
+        size = 0
+
+        with self.lock:
+            seq, offset = self.cursor
+            while len(messages) < max_count:
+                record = self.segments[seq].read(offset)
+                if record is None:
+                    if seq == self.tail:
+                        break
+                    seq, offset = seq + 1, 0
+                    continue
+
+                data, next_offset = record
+                if messages and size + len(data) > max_bytes:
+                    break
+                messages.append(data)
+                size += len(data)
+                offset = next_offset
+
+        return messages, (seq, offset)
+
+    def commit(self, position, count):
+        """Mark the count messages up to position as sent"""
+
+        with self.lock:
+            if position[0] not in self.segments:
+                # Dropped while they were being sent
+                return
+            self.cursor = position
+            self.pending = max(self.pending - count, 0)
+
+            # Finished segments can go
+            for seq in sorted(self.segments):
+                if seq >= position[0] or seq == self.tail:
+                    break
+                self.segments.pop(seq).remove()
+
+            self._save_cursor()
+
+    def sync(self):
+        """Flush appended messages to disk, from a thread that can afford to wait"""
+
+        with self.lock:
+            segment = self.segments[self.tail]
+        segment.sync()
+
+    def close(self):
+        with self.lock:
+            self._save_cursor()
+            for segment in self.segments.values():
+                segment.sync()
+                segment.close()
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+"""
+Turns what is shown on the PDA screen into pool state (temperatures and equipment on/off).
+
+Only the lines that changed since the last screen flush are parsed. Values are kept once seen, so a reading stays
+available after the controller moves on to another page.
+"""
+
+from __future__ import (division, print_function)
+
+import logging
+import re
+import time
+
+
+class PoolState(object):
+    """Pool state parsed incrementally from screen updates"""
+
+    # "  AIR       POOL  " on one line with "  61`       56`  " on the next
+    temp_labels = re.compile(r'\b(AIR|POOL|SPA)\b')
+    temp_values = re.compile(r'(-?\d+)\s*`')
+
+    # "FILTER PUMP   ON", "SPA HEATER   OFF", "POOL HEATER ENA"
+    equipment = re.compile(r'^\s*([A-Z][A-Z0-9 ]*?)\s+(ON|OFF|ENA)\s*$')
+
+    def __init__(self, screen=None):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.values = {}
+        self.updated = {}
+        self.subscribers = []
+
+        if screen is not None:
+            screen.subscribe(self.update)
+
+    def subscribe(self, callback):
+        """callback(changes) is called with a {name: value} dict whenever values change"""
+
+        self.subscribers.append(callback)
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def update(self, screen, lines):
+        """Screen subscriber, parse the changed lines"""
+
+        changes = {}
+
+        for row, text in lines.items():
+            if not text:
+                continue
+
+            match = PoolState.equipment.match(text)
+            if match:
+                name = match.group(1).strip().lower().replace(' ', '_')
+                self._set(changes, name, match.group(2) != 'OFF')
+                continue
+
+            if '`' in text and row > 0:
+                self._parse_temps(changes, screen.line(row - 1), text)
+            elif row + 1 < screen.rows and row + 1 not in lines:
+                # Labels changed but the values line did not
+                below = screen.line(row + 1)
+                if '`' in below:
+                    self._parse_temps(changes, text, below)
+
+        if changes:
+            self.log.debug('State changed: ' + str(changes))
+            for callback in self.subscribers:
+                callback(changes)
+
+    def refresh(self, screen):
+        """Parse everything on the screen, so values still showing count as just read"""
+
+        self.update(screen, dict(enumerate(screen.lines())))
+
+    def _parse_temps(self, changes, labels, values):
+        names = PoolState.temp_labels.findall(labels)
+        temps = PoolState.temp_values.findall(values)
+        for name, temp in zip(names, temps):
+            self._set(changes, name.lower() + '_temp', int(temp))
+
+    def _set(self, changes, name, value):
+        self.updated[name] = time.time()
+        if self.values.get(name) != value:
+            self.values[name] = value
+            changes[name] = value
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
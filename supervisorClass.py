@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+"""
+Runs several controllers, one per serial port, from a single process.
+
+Each port gets its own worker thread with its own event loop, so the bus on one port is serviced independently of
+the others and a slow or stuck controller can't hold up the rest. State changes and snapshots are handed back to the
+main loop tagged with the name of the controller they came from.
+"""
+
+from __future__ import (division, print_function)
+
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from interfaceClass import Interface
+from metricsUtils import registry
+
+
+class Worker(threading.Thread):
+    """Owns one Interface and the event loop servicing its port"""
+
+    def __init__(self, tag, controller, port, capture_file=''):
+        threading.Thread.__init__(self, name='bus-' + tag)
+        self.daemon = True
+
+        self.log = logging.getLogger(self.__class__.__name__ + '.' + tag)
+
+        self.tag = tag
+        self.controller = controller
+        self.port = port
+        self.capture_file = capture_file
+
+        self.loop = None
+        self.iface = None
+
+        # started is set once the interface is up or has failed, ready only if it came up, error says why not
+        self.started = threading.Event()
+        self.ready = threading.Event()
+        self.error = None
+
+        # Called in the main loop with (tag, changes)
+        self.forward = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        # Failures are handed back to the supervisor, exiting from here would only end this thread
+        try:
+            self._setup()
+        except Exception as e:
+            self.log.exception('Unable to start the ' + self.controller + ' interface on ' + self.port)
+            self.error = e
+            self.loop.close()
+            return
+        finally:
+            self.started.set()
+
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.iface.detach(self.loop)
+            if self.capture_file != '':
+                self.iface.stop_capture()
+            self.loop.close()
+
+    def _setup(self):
+        self.log.info('Creating ' + self.controller + ' interface on port ' + self.port)
+        self.iface = Interface(self.controller, self.port)
+
+        if self.capture_file != '':
+            self.iface.start_capture(self.capture_file)
+
+        self.iface.subscribe(self._changed)
+        self.iface.register_metrics(registry, controller=self.tag)
+        self.iface.attach(self.loop)
+
+    def _changed(self, changes):
+        if self.forward is not None:
+            self.forward(self.tag, changes)
+
+    def call(self, coro):
+        """Run a coroutine on this worker's loop, returns an awaitable for the calling loop"""
+
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def frames(self):
+        return self.iface.iface.decoder.frame_count if self.iface is not None else 0
+
+    def stop(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class Supervisor(object):
+    """Starts a worker per port and merges what they report"""
+
+    # Seconds between per-port throughput reports
+    report_interval = 60
+
+    def __init__(self, controller, ports, capture_file=''):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.workers = {}
+        for spec in ports:
+            tag, port = Supervisor.parse_port(spec)
+            if tag in self.workers:
+                self.log.critical('Controller name ' + tag + ' used twice')
+            capture = ''
+            if capture_file != '':
+                capture = capture_file if len(ports) == 1 else capture_file + '.' + tag
+            self.workers[tag] = Worker(tag, controller, port, capture)
+
+        self.subscribers = []
+        self.loop = None
+
+    @staticmethod
+    def parse_port(spec):
+        """'name=/dev/ttyUSB0' or just '/dev/ttyUSB0', which is named after the device"""
+
+        if '=' in spec:
+            tag, port = spec.split('=', 1)
+        else:
+            tag, port = os.path.basename(spec), spec
+        return tag, port
+
+    def tags(self):
+        return sorted(self.workers)
+
+    def subscribe(self, callback):
+        """callback(tag, changes) is called on the main loop whenever a controller's state changes"""
+
+        self.subscribers.append(callback)
+
+    def _forward(self, tag, changes):
+        # Runs on a worker thread, hand over to the main loop
+        self.loop.call_soon_threadsafe(self._changed, tag, dict(changes))
+
+    def _changed(self, tag, changes):
+        for callback in self.subscribers:
+            callback(tag, changes)
+
+    def start(self, loop):
+        """Start every worker and wait for its interface to come up, exits if any of them fail"""
+
+        self.loop = loop
+        for worker in self.workers.values():
+            worker.forward = self._forward
+            worker.start()
+
+        for tag in self.tags():
+            worker = self.workers[tag]
+            worker.started.wait()
+            if worker.error is not None:
+                self.stop()
+                self.log.critical('Controller ' + tag + ' failed to start: ' + str(worker.error))
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+        for worker in self.workers.values():
+            worker.join(5)
+
+    def acking(self):
+        """True once every controller has been answered at least once"""
+
+        return all(worker.ready.is_set() and worker.iface.iface.acks.latency.count
+                   for worker in self.workers.values())
+
+    async def read_all(self):
+        """Snapshot from every controller that is up, read in parallel, as {tag: snapshot}"""
+
+        tags = [tag for tag in self.tags() if self.workers[tag].ready.is_set()]
+        results = await asyncio.gather(*[self.workers[tag].call(self.workers[tag].iface.read_all()) for tag in tags],
+                                       return_exceptions=True)
+
+        snapshots = {}
+        for tag, result in zip(tags, results):
+            if isinstance(result, Exception):
+                self.log.error('Reading ' + tag + ' failed: ' + repr(result))
+            else:
+                snapshots[tag] = result
+        return snapshots
+
+    async def call(self, tag, coro_fn, *args):
+        """Run coro_fn(interface, *args) on the named controller's loop"""
+
+        worker = self.workers[tag]
+        return await worker.call(coro_fn(worker.iface, *args))
+
+    async def monitor(self):
+        """Log frames per second for each port"""
+
+        last = dict((tag, worker.frames()) for tag, worker in self.workers.items())
+        last_time = time.time()
+
+        while True:
+            await asyncio.sleep(Supervisor.report_interval)
+
+            now = time.time()
+            elapsed = now - last_time
+            last_time = now
+
+            rates = []
+            for tag in self.tags():
+                frames = self.workers[tag].frames()
+                rates.append('{0} {1:.1f}'.format(tag, (frames - last[tag]) / elapsed))
+                last[tag] = frames
+            self.log.info('Frames/s per port: ' + ', '.join(rates))
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')
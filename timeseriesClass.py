@@ -0,0 +1,361 @@
+#!/usr/bin/python
+
+"""
+Local append-only store for pool telemetry.
+
+Each snapshot is written as a fixed width record (timestamp plus one float per field) to a raw series, and rolled up
+into 1 minute, 1 hour and 1 day series holding the sample count and the mean, min and max of every field. Records are
+time ordered and fixed width, so a small in-memory index of the first timestamp in each block is enough for a range
+query to read only the blocks it needs.
+"""
+
+from __future__ import (division, print_function)
+
+import array
+import bisect
+import json
+import logging
+import math
+import os
+import struct
+import time
+
+
+nan = float('nan')
+
+
+class Series(object):
+    """One file of fixed width, time ordered records"""
+
+    # Records per index block
+    block_records = 256
+
+    def __init__(self, filename, record):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.filename = filename
+        self.record = record
+        self.block_bytes = record.size * Series.block_records
+
+        self.fh = open(filename, 'a+b')
+        self.fh.seek(0, os.SEEK_END)
+        size = self.fh.tell()
+
+        # Drop a partial record left by a crash mid write
+        if size % record.size:
+            self.log.warning('Truncating partial record in ' + filename)
+            size -= size % record.size
+            self.fh.truncate(size)
+
+        self.count = size // record.size
+
+        # First timestamp of every block
+        self.index = array.array('d')
+        for offset in range(0, size, self.block_bytes):
+            self.fh.seek(offset)
+            self.index.append(record.unpack(self.fh.read(record.size))[0])
+
+    def last(self):
+        """The newest record, or None"""
+
+        if not self.count:
+            return None
+        self.fh.seek((self.count - 1) * self.record.size)
+        return self.record.unpack(self.fh.read(self.record.size))
+
+    def append(self, values):
+        if self.count % Series.block_records == 0:
+            self.index.append(values[0])
+
+        self.fh.seek(0, os.SEEK_END)
+        self.fh.write(self.record.pack(*values))
+        self.fh.flush()
+        self.count += 1
+
+    def read(self, start, end):
+        """Yield the records with start <= timestamp < end"""
+
+        block = max(bisect.bisect_right(self.index, start) - 1, 0)
+        stop = bisect.bisect_left(self.index, end)
+
+        for i in range(block, stop):
+            self.fh.seek(i * self.block_bytes)
+            data = self.fh.read(self.block_bytes)
+            data = data[:len(data) - len(data) % self.record.size]
+            for values in self.record.iter_unpack(data):
+                if values[0] >= end:
+                    return
+                if values[0] >= start:
+                    yield values
+
+    def close(self):
+        self.fh.close()
+
+
+class Rollup(object):
+    """Running count, mean, min and max of every field over one bucket"""
+
+    def __init__(self, nfields, start):
+        self.start = start
+        self.count = 0
+        self.sums = [0.0] * nfields
+        self.weights = [0] * nfields
+        self.mins = [nan] * nfields
+        self.maxs = [nan] * nfields
+
+    def add(self, count, means, mins, maxs):
+        self.count += count
+        for i in range(len(self.sums)):
+            if math.isnan(means[i]):
+                continue
+            self.sums[i] += means[i] * count
+            self.weights[i] += count
+            if not mins[i] >= self.mins[i]:
+                self.mins[i] = mins[i]
+            if not maxs[i] <= self.maxs[i]:
+                self.maxs[i] = maxs[i]
+
+    def values(self):
+        """Record values: start, count, then mean/min/max for each field"""
+
+        values = [self.start, self.count]
+        for i in range(len(self.sums)):
+            values.append(self.sums[i] / self.weights[i] if self.weights[i] else nan)
+            values.append(self.mins[i])
+            values.append(self.maxs[i])
+        return values
+
+
+class TimeSeriesStore(object):
+    """Raw samples plus 1m, 1h and 1d rollups for a fixed set of fields"""
+
+    # name: bucket length in seconds, coarsest last
+    resolutions = (('1m', 60), ('1h', 3600), ('1d', 86400))
+
+    def __init__(self, path, fields):
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # The field list fixes the record layout, so it must match what is on disk
+        schema_file = os.path.join(path, 'fields.json')
+        if os.path.exists(schema_file):
+            with open(schema_file) as fh:
+                stored = json.load(fh)
+            if stored != list(fields):
+                self.log.critical('Telemetry fields ' + str(list(fields)) + ' do not match ' + str(stored) +
+                                  ' stored in ' + path)
+        else:
+            with open(schema_file, 'w') as fh:
+                json.dump(list(fields), fh)
+
+        self.fields = list(fields)
+        n = len(self.fields)
+
+        self.raw = Series(os.path.join(path, 'raw.dat'), struct.Struct('<d' + 'f' * n))
+        self.series = {}
+        for name, seconds in TimeSeriesStore.resolutions:
+            self.series[name] = Series(os.path.join(path, name + '.dat'), struct.Struct('<dI' + 'f' * (3 * n)))
+
+        # Bucket being filled at each resolution
+        self.rollups = {}
+        self._rebuild()
+
+        last = self.raw.last()
+        self.last_time = last[0] if last else 0.0
+
+        self.log.info('Opened ' + path + ' with ' + str(self.raw.count) + ' samples')
+
+    def _rebuild(self):
+        """Recreate the partly filled buckets from the finer series after a restart"""
+
+        source = self.raw
+        for name, seconds in TimeSeriesStore.resolutions:
+            last = self.series[name].last()
+            start = last[0] + seconds if last else 0.0
+            for values in source.read(start, float('inf')):
+                self._add(name, seconds, values, source is self.raw, write=False)
+            source = self.series[name]
+
+    def _add(self, name, seconds, values, raw, write=True):
+        """Add a raw sample or a finer rollup record to the bucket at this resolution"""
+
+        start = values[0] - values[0] % seconds
+        rollup = self.rollups.get(name)
+
+        if rollup is not None and rollup.start != start:
+            if write:
+                finished = rollup.values()
+                self.series[name].append(finished)
+                self._cascade(name, finished)
+            rollup = None
+
+        if rollup is None:
+            rollup = self.rollups[name] = Rollup(len(self.fields), start)
+
+        if raw:
+            samples = values[1:]
+            rollup.add(1, samples, samples, samples)
+        else:
+            rollup.add(values[1], values[2::3], values[3::3], values[4::3])
+
+    def _cascade(self, name, record):
+        """Feed a finished bucket into the next coarser resolution"""
+
+        names = [r[0] for r in TimeSeriesStore.resolutions]
+        i = names.index(name) + 1
+        if i < len(names):
+            self._add(names[i], TimeSeriesStore.resolutions[i][1], record, False)
+
+    def _partial(self, name):
+        """The buckets still being filled at a resolution, oldest first, made up of the open bucket at this and every
+        finer resolution. Finer buckets can already be past the coarse one, e.g. just after midnight, so the newest
+        samples can be in a bucket of their own."""
+
+        seconds = dict(TimeSeriesStore.resolutions)[name]
+        totals = {}
+        for finer, finer_seconds in TimeSeriesStore.resolutions:
+            partial = self.rollups.get(finer)
+            if partial is not None:
+                start = partial.start - partial.start % seconds
+                if start not in totals:
+                    totals[start] = Rollup(len(self.fields), start)
+                values = partial.values()
+                totals[start].add(values[1], values[2::3], values[3::3], values[4::3])
+            if finer == name:
+                break
+
+        return [totals[start] for start in sorted(totals)]
+
+    def append(self, snapshot, when=None):
+        """Store a snapshot dict, missing fields are stored as NaN and booleans as 0/1"""
+
+        if when is None:
+            when = time.time()
+
+        if when <= self.last_time:
+            self.log.warning('Dropping sample older than the last one stored')
+            return
+
+        values = [when]
+        for field in self.fields:
+            value = snapshot.get(field)
+            values.append(nan if value is None else float(value))
+
+        self.raw.append(values)
+        self.last_time = when
+
+        name, seconds = TimeSeriesStore.resolutions[0]
+        self._add(name, seconds, values, True)
+
+    def pick_resolution(self, start, end):
+        """Coarsest useful resolution for a time range"""
+
+        span = end - start
+        if span <= 2 * 3600:
+            return 'raw'
+        if span <= 2 * 86400:
+            return '1m'
+        if span <= 60 * 86400:
+            return '1h'
+        return '1d'
+
+    def query(self, start, end=None, resolution=None):
+        """Records between start and end as dicts with a 'time' key.
+
+        Raw records have one value per field. Rollups have 'count', and the mean per field with _min and _max
+        variants. The bucket still being filled is included."""
+
+        if end is None:
+            end = time.time()
+        if resolution is None:
+            resolution = self.pick_resolution(start, end)
+
+        results = []
+
+        if resolution == 'raw':
+            for values in self.raw.read(start, end):
+                record = {'time': values[0]}
+                record.update(zip(self.fields, values[1:]))
+                results.append(record)
+            return results
+
+        records = list(self.series[resolution].read(start, end))
+        for rollup in self._partial(resolution):
+            if start <= rollup.start < end:
+                records.append(rollup.values())
+
+        for values in records:
+            record = {'time': values[0], 'count': values[1]}
+            for i, field in enumerate(self.fields):
+                record[field] = values[2 + 3 * i]
+                record[field + '_min'] = values[3 + 3 * i]
+                record[field + '_max'] = values[4 + 3 * i]
+            results.append(record)
+
+        return results
+
+    def summary(self, field, start, end=None):
+        """Mean, min and max of one field over a time range, e.g. the pool temperature this morning"""
+
+        return self._summarise(field, self.query(start, end), start)
+
+    @staticmethod
+    def _summarise(field, records, start):
+        total = Rollup(1, start)
+
+        for record in records:
+            if 'count' in record:
+                total.add(record['count'], [record[field]], [record[field + '_min']], [record[field + '_max']])
+            else:
+                value = [record[field]]
+                total.add(1, value, value, value)
+
+        mean, low, high = total.values()[2:]
+        return {'count': total.count, 'mean': mean, 'min': low, 'max': high}
+
+    def history(self, field, start, end=None, resolution=None):
+        """One field's records and summary over a time range, for answering a history command.
+        Gaps come back as None rather than NaN so the result can go out as JSON. Raises ValueError for an unknown
+        field or resolution."""
+
+        if field not in self.fields:
+            raise ValueError('no history kept for ' + repr(field))
+        if end is None:
+            end = time.time()
+        if resolution is None:
+            resolution = self.pick_resolution(start, end)
+        elif resolution != 'raw' and resolution not in self.series:
+            raise ValueError('unknown resolution ' + repr(resolution))
+
+        records = self.query(start, end, resolution)
+
+        def clean(value):
+            return None if math.isnan(value) else value
+
+        rows = []
+        for record in records:
+            if 'count' in record:
+                rows.append({'time': record['time'], 'count': record['count'], 'mean': clean(record[field]),
+                             'min': clean(record[field + '_min']), 'max': clean(record[field + '_max'])})
+            else:
+                rows.append({'time': record['time'], 'value': clean(record[field])})
+
+        summary = TimeSeriesStore._summarise(field, records, start)
+        summary = dict((name, clean(value)) for name, value in summary.items())
+
+        return {'field': field, 'resolution': resolution, 'summary': summary, 'records': rows}
+
+    def close(self):
+        self.raw.close()
+        for series in self.series.values():
+            series.close()
+
+
+# execute as standalone program
+if __name__ == '__main__':
+    print('This is a Python module, not designed to be run as a standalone program')